@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Benchmarks for img4.py: generates synthetic IM4P/IM4M/IMG4 files and measures
+# detection, parsing, manifest access, payload extraction and decompression.
+
+import os
+import sys
+import json
+import time
+import mmap
+import random
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+import img4
+
+
+DEFAULT_SIZES = '1K,64K,1M,16M,256M,1G'
+DEFAULT_CATEGORIES = '10,100,1000'
+SIZE_UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+def parse_size(s):
+    s = s.strip().upper()
+    if s[-1:] in SIZE_UNITS:
+        return int(s[:-1]) * SIZE_UNITS[s[-1]]
+    return int(s)
+
+def format_size(n):
+    for unit in ('G', 'M', 'K'):
+        if n >= SIZE_UNITS[unit] and not n % SIZE_UNITS[unit]:
+            return '{}{}'.format(n // SIZE_UNITS[unit], unit)
+    return str(n)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+# Input generation
+
+def iter_raw_data(size, seed=0):
+    """ deterministic, moderately compressible data: random runs mixed with repeated text """
+    rng = random.Random(seed)
+    text = b'__TEXT,__text __DATA,__const kernelcache IOKit ' * 64
+    remaining = size
+    while remaining > 0:
+        block = rng.randbytes(1 << 16) + text * 12
+        yield block[:remaining]
+        remaining -= len(block[:remaining])
+
+def iter_lzfse_data(size, seed=0):
+    """ LZFSE-compress data in independent 1 MiB pieces, joined into a single stream """
+    import lzfse
+
+    pending = b''
+    for chunk in iter_raw_data(size, seed):
+        pending += chunk
+        while len(pending) >= 1 << 20:
+            yield lzfse.compress(pending[:1 << 20])[:-len(img4.LZFSE_END_MAGIC)]
+            pending = pending[1 << 20:]
+    if pending:
+        yield lzfse.compress(pending)[:-len(img4.LZFSE_END_MAGIC)]
+    yield img4.LZFSE_END_MAGIC
+
+def generate_payload(workdir, size, compressed=False, keybags=False):
+    name = 'payload-{}{}{}'.format(format_size(size), '-lzfse' if compressed else '', '-keybags' if keybags else '')
+    path = os.path.join(workdir, name + '.im4p')
+    if os.path.exists(path):
+        return path
+
+    raw_path = os.path.join(workdir, name + '.raw')
+    with open(raw_path, 'wb') as f:
+        for chunk in (iter_lzfse_data if compressed else iter_raw_data)(size):
+            f.write(chunk)
+    with open(raw_path, 'rb') as data, open(path + '.tmp', 'wb') as f:
+        img4.build_payload(f, 'bnch', 'benchmark payload', data,
+            compression={'algorithm': 'lzfse', 'original_size': size} if compressed else None,
+            keybags=[{'id': 1, 'iv': bytes(16), 'key': bytes(32)}, {'id': 2, 'iv': bytes(16), 'key': bytes(32)}] if keybags else None,
+        )
+    os.remove(raw_path)
+    os.rename(path + '.tmp', path)
+    return path
+
+def _der(cls, constructed, tag, content):
+    return img4._der_encode_header(cls, constructed, tag, len(content)) + content
+
+def _ia5(s):
+    return _der(0, False, 22, s.encode('ascii'))
+
+def _property(key, value):
+    return _der(3, True, img4.ascii2int(key), _der(0, True, 16, _ia5(key) + value))
+
+def generate_manifest(workdir, categories, properties=8):
+    path = os.path.join(workdir, 'manifest-{}.im4m'.format(categories))
+    if os.path.exists(path):
+        return path
+
+    rng = random.Random(categories)
+    cats = [_property('MANP', _der(0, True, 17, b''.join([
+        _property('ECID', _der(0, False, 2, rng.randbytes(8))),
+        _property('CPID', _der(0, False, 2, b'\x00\x80\x20')),
+        _property('BNCH', _der(0, False, 4, rng.randbytes(48))),
+    ])))]
+    for i in range(categories):
+        values = [_property('DGST', _der(0, False, 4, rng.randbytes(48)))]
+        for j in range(properties - 1):
+            values.append(_property('P{:03}'.format(j), _der(0, False, 1, b'\xff')))
+        cats.append(_property('c{:03}'.format(i % 1000), _der(0, True, 17, b''.join(values))))
+    body = _der(3, True, img4.ascii2int('MANB'), _der(0, True, 16, _ia5('MANB') + _der(0, True, 17, b''.join(cats))))
+    manifest = _der(0, True, 16, b''.join([
+        _ia5('IM4M'), _der(0, False, 2, b'\x00'), _der(0, True, 17, body),
+        _der(0, False, 4, rng.randbytes(256)), _der(0, True, 16, b''),
+    ]))
+    with open(path, 'wb') as f:
+        f.write(manifest)
+    return path
+
+def generate_img4(workdir, payload_path, manifest_path):
+    path = os.path.join(workdir, os.path.basename(payload_path)[:-len('.im4p')] + '.img4')
+    if os.path.exists(path):
+        return path
+    with open(payload_path, 'rb') as payload, open(manifest_path, 'rb') as manifest, open(path + '.tmp', 'wb') as f:
+        img4.build_img4(f, payload, manifest.read())
+    os.rename(path + '.tmp', path)
+    return path
+
+
+# Benchmarks: each takes a path and returns the number of bytes processed
+
+def bench_detect(path):
+    with open(path, 'rb') as f:
+        img4.detect(f.read(64))
+    return 0
+
+def bench_native(path):
+    with open(path, 'rb') as f:
+        img4.load(f.read()).native
+    return os.path.getsize(path)
+
+def bench_describe(path):
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        img4.describe(m)
+    return os.path.getsize(path)
+
+def bench_manifest_native(path):
+    with open(path, 'rb') as f:
+        m = img4.load(f.read()).native
+    for body in m['contents']:
+        for c in body['categories']:
+            for v in c['category']['values']:
+                pass
+    return os.path.getsize(path)
+
+def bench_manifest_view(path):
+    with open(path, 'rb') as f:
+        for _ in img4.iter_manifest_properties(f.read()):
+            pass
+    return os.path.getsize(path)
+
+def bench_manifest_lookup(path):
+    with open(path, 'rb') as f:
+        img4.IMG4ManifestView(f.read()).get('MANP', 'ECID')
+    return os.path.getsize(path)
+
+def bench_extract(path):
+    # write to a real file: /dev/null would never touch the mapped input pages
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m, open(path + '.out', 'wb') as out:
+        written = img4.extract_payload(m, out)[2]
+    os.remove(path + '.out')
+    return written
+
+BENCHMARKS = {
+    'detect':          bench_detect,
+    'native':          bench_native,
+    'describe':        bench_describe,
+    'manifest-native': bench_manifest_native,
+    'manifest-view':   bench_manifest_view,
+    'manifest-lookup': bench_manifest_lookup,
+    'extract':         bench_extract,
+    'decompress':      bench_extract,
+}
+
+def run_case(case):
+    """ run one benchmark case repeatedly (in a fresh process), returning its measurements """
+    func = BENCHMARKS[case['benchmark']]
+    latencies = []
+    size = 0
+    deadline = time.perf_counter() + case['time_limit']
+    for _ in range(case['repeat']):
+        start = time.perf_counter()
+        size = func(case['path'])
+        latencies.append(time.perf_counter() - start)
+        if time.perf_counter() > deadline:
+            break
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        # kilobytes everywhere but macOS, which reports bytes
+        peak_rss *= 1024
+    return dict(case, **summarize(latencies, size), peak_rss=peak_rss)
+
+def summarize(latencies, size):
+    median = percentile(latencies, 50)
+    return {
+        'runs': len(latencies),
+        'bytes': size,
+        'p50': median,
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'throughput': size / median if median else None,
+    }
+
+def bench_import(repeat):
+    """ time a fresh interpreter importing img4, minus bare interpreter startup, and check x509 stays unloaded """
+    def timed(code):
+        start = time.perf_counter()
+        out = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        return time.perf_counter() - start, out
+
+    baseline = [timed('pass')[0] for _ in range(repeat)]
+    code = 'import sys, img4; print("asn1crypto.x509" in sys.modules)'
+    runs = [timed(code) for _ in range(repeat)]
+    latencies = [max(0.0, t - percentile(baseline, 50)) for t, _ in runs]
+    result = dict(benchmark='import', variant='', path=None, **summarize(latencies, 0))
+    result['throughput'] = None
+    result['x509_imported'] = any(out.strip() == 'True' for _, out in runs)
+    return result
+
+
+def compare(results, baseline, threshold):
+    """ print results whose median latency regressed by more than threshold against a previous run """
+    previous = {(r['benchmark'], r['variant']): r for r in baseline['results']}
+    regressions = 0
+    for r in results:
+        old = previous.get((r['benchmark'], r['variant']))
+        if not old or not old['p50']:
+            continue
+        ratio = r['p50'] / old['p50']
+        if ratio > 1 + threshold:
+            print('REGRESSION {} {}: p50 {:.6f}s -> {:.6f}s ({:+.0%})'.format(r['benchmark'], r['variant'], old['p50'], r['p50'], ratio - 1))
+            regressions += 1
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='benchmark img4.py on synthetic files')
+    parser.add_argument('-s', '--sizes', default=DEFAULT_SIZES, help='comma-separated payload sizes (default: %(default)s)')
+    parser.add_argument('-c', '--categories', default=DEFAULT_CATEGORIES, help='comma-separated manifest category counts (default: %(default)s)')
+    parser.add_argument('-b', '--benchmarks', default=','.join(list(BENCHMARKS) + ['import']), help='comma-separated benchmarks to run (default: all)')
+    parser.add_argument('-n', '--repeat', type=int, default=10, help='maximum runs per case (default: %(default)s)')
+    parser.add_argument('-t', '--time-limit', type=float, default=10, help='stop repeating a case after this many seconds (default: %(default)s)')
+    parser.add_argument('--native-limit', default='256M', help='largest payload to fully decode with .native (default: %(default)s)')
+    parser.add_argument('-w', '--workdir', help='directory for generated files, reused between runs (default: temporary)')
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'), help='write results as JSON to this file')
+    parser.add_argument('--compare', type=argparse.FileType('r'), help='previous JSON results to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative p50 slowdown counted as regression (default: %(default)s)')
+    args = parser.parse_args()
+
+    sizes = [parse_size(s) for s in args.sizes.split(',') if s]
+    category_counts = [int(c) for c in args.categories.split(',') if c]
+    benchmarks = args.benchmarks.split(',')
+    native_limit = parse_size(args.native_limit)
+    try:
+        import lzfse
+        have_lzfse = True
+    except ImportError:
+        print('lzfse not available: skipping compressed payloads', file=sys.stderr)
+        have_lzfse = False
+
+    tmpdir = None
+    if args.workdir:
+        workdir = args.workdir
+        os.makedirs(workdir, exist_ok=True)
+    else:
+        tmpdir = tempfile.TemporaryDirectory(prefix='img4-bench-')
+        workdir = tmpdir.name
+
+    print('generating inputs in {}...'.format(workdir), file=sys.stderr)
+    manifests = {n: generate_manifest(workdir, n) for n in category_counts}
+    cases = []
+    def add(benchmark, variant, path):
+        if benchmark in benchmarks:
+            cases.append({'benchmark': benchmark, 'variant': variant, 'path': path, 'repeat': args.repeat, 'time_limit': args.time_limit})
+
+    for size in sizes:
+        for compressed in ((False, True) if have_lzfse else (False,)):
+            for keybags in (False, True):
+                if keybags and compressed:
+                    continue
+                payload = generate_payload(workdir, size, compressed=compressed, keybags=keybags)
+                variant = '{}{}{}'.format(format_size(size), ' lzfse' if compressed else '', ' keybags' if keybags else '')
+                add('detect', variant, payload)
+                add('describe', variant, payload)
+                if size <= native_limit:
+                    add('native', variant, payload)
+                add('decompress' if compressed else 'extract', variant, payload)
+        if manifests:
+            combined = generate_img4(workdir, generate_payload(workdir, size), manifests[min(manifests)])
+            add('describe', '{} img4'.format(format_size(size)), combined)
+    for n, manifest in manifests.items():
+        variant = '{} categories'.format(n)
+        add('detect', variant, manifest)
+        add('native', variant, manifest)
+        add('manifest-native', variant, manifest)
+        add('manifest-view', variant, manifest)
+        add('manifest-lookup', variant, manifest)
+
+    results = []
+    if 'import' in benchmarks:
+        results.append(bench_import(args.repeat))
+    # a fresh process per case keeps peak RSS measurements independent
+    ctx = multiprocessing.get_context('spawn')
+    for case in cases:
+        with ctx.Pool(1) as pool:
+            results.append(pool.apply(run_case, (case,)))
+
+    print('{:16} {:24} {:>5} {:>11} {:>11} {:>11} {:>12} {:>10}'.format('benchmark', 'variant', 'runs', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'MB/s', 'RSS (MB)'))
+    for r in results:
+        print('{:16} {:24} {:5} {:11.3f} {:11.3f} {:11.3f} {:>12} {:>10}'.format(
+            r['benchmark'], r['variant'], r['runs'], r['p50'] * 1e3, r['p90'] * 1e3, r['p99'] * 1e3,
+            '{:.1f}'.format(r['throughput'] / 1e6) if r['throughput'] else '-',
+            '{:.1f}'.format(r['peak_rss'] / 1e6) if r.get('peak_rss') else '-',
+        ))
+    if 'import' in benchmarks and results[0]['x509_imported']:
+        print('warning: importing img4 also imported asn1crypto.x509', file=sys.stderr)
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if args.output:
+        json.dump(report, args.output, indent=2)
+        args.output.write('\n')
+    if tmpdir:
+        tmpdir.cleanup()
+    if args.compare and compare(results, json.load(args.compare), args.threshold):
+        sys.exit(1)
@@ -3,7 +3,17 @@
 # Greetings to:
 # - hexdump tool of choice
 
+import os
+import sys
+import re
 import enum
+import mmap
+import heapq
+import bisect
+import struct
+import hashlib
+import itertools
+import collections
 import restruct
 
 
@@ -29,8 +39,10 @@ PROPERTY_TYPES = {
     'name': DeviceTreeType.String,
 }
 
+PRINTABLE = bytes(range(0x20, 0x7F))
+
 def isprint(x):
-    return all(0x7E >= b >= 0x20 for b in x)
+    return not bytes(x).translate(None, PRINTABLE)
 
 def determine_type(k, v):
     if k in PROPERTY_TYPES:
@@ -45,16 +57,49 @@ def determine_type(k, v):
         return DeviceTreeType.Empty
     return DeviceTreeType.Opaque
 
+VALUE_TYPES = {
+    type(None): DeviceTreeType.Empty,
+    int:   DeviceTreeType.U32,
+    str:   DeviceTreeType.String,
+    list:  DeviceTreeType.StringList,
+    bytes: DeviceTreeType.Opaque,
+}
+
 def determine_reverse_type(k, v):
     if k in PROPERTY_TYPES:
         return PROPERTY_TYPES[k]
-    return {
-        type(None): DeviceTreeType.Empty,
-        int:   DeviceTreeType.U32,
-        str:   DeviceTreeType.String,
-        list:  DeviceTreeType.StringList,
-        bytes: DeviceTreeType.Opaque,
-    }[type(v)]
+    return VALUE_TYPES[type(v)]
+
+def decode_value(type, v, order):
+    """ decode raw property bytes like the restruct property types would, in the given byte order """
+    if type is DeviceTreeType.Empty:
+        return None
+    if type in (DeviceTreeType.U32, DeviceTreeType.Handle):
+        return int.from_bytes(v[:4], order)
+    if type is DeviceTreeType.U64:
+        return int.from_bytes(v[:8], order)
+    if type is DeviceTreeType.String:
+        return bytes(v).split(b'\x00', 1)[0].decode()
+    if type is DeviceTreeType.StringList:
+        parts = bytes(v).split(b'\x00')
+        if not parts[-1]:
+            parts.pop()
+        return [x.decode() for x in parts]
+    return bytes(v)
+
+def encode_value(type, v, order):
+    """ encode a property value to raw bytes, the inverse of decode_value() """
+    if type is DeviceTreeType.Empty:
+        return b''
+    if type in (DeviceTreeType.U32, DeviceTreeType.Handle):
+        return v.to_bytes(4, order)
+    if type is DeviceTreeType.U64:
+        return v.to_bytes(8, order)
+    if type is DeviceTreeType.String:
+        return v.encode() + b'\x00'
+    if type is DeviceTreeType.StringList:
+        return b''.join(x.encode() + b'\x00' for x in v)
+    return bytes(v)
 
 
 FDT_PROPERTY_TYPES = {
@@ -123,6 +168,8 @@ class FlattenedDeviceTree(restruct.Struct, partials={'MemOff', 'StruOff', 'StruS
     def on_parse_strings(self, spec, context):
         context.user.strings_offset = self.strings_offset
 
+FDT_MAGIC = b'\xd0\x0d\xfe\xed'
+FDT_HEADER = struct.Struct('>4sIIIIIIIII')
 
 
 ADT_PROPERTY_TYPES = {
@@ -155,6 +202,41 @@ class ADTNode(restruct.Struct, recursive=True, partials={'PropArr', 'ChildArr'})
 
 AppleDeviceTree = ADTNode
 
+ADT_NODE_HEADER = struct.Struct('<II')
+ADT_PROPERTY_HEADER = struct.Struct('<32sI')
+
+class LazyADTProperty(ADTProperty):
+    """ an ADTProperty that only decodes and types its value from the underlying buffer when it is first accessed """
+
+    def __init__(self, name, template, buf, start, end):
+        super().__init__(name=name, template=template)
+        # after the base initialiser, in case it assigns a default value through the setter below
+        self._span = (buf, start, end)
+        self._value = None
+        self._decoded = False
+
+    @property
+    def raw(self):
+        """ the undecoded value bytes, or None once the value has been replaced """
+        if not self._span:
+            return None
+        buf, start, end = self._span
+        return buf[start:end]
+
+    @property
+    def value(self):
+        if not self._decoded:
+            data = self.raw
+            self._value = decode_value(determine_type(self.name, data), data, 'little')
+            self._decoded = True
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+        self._decoded = True
+        self._span = None
+
 
 
 class DeviceTreeRange(restruct.Struct, generics={'ChildAddrSize', 'ParentAddrSize', 'LengthSize'}):
@@ -168,82 +250,480 @@ class DeviceTreeRegister(restruct.Struct, generics={'AddrSize', 'LengthSize'}):
 
 
 
-def dump_value(n, v):
-    return restruct.format_value(v, str)
-
-def dump(node, depth=0, last=True):
-    space = ' ' * (depth * 2)
-    if last and not node.children:
-        leader = '    '
-    else:
-        leader = '|   '
-
-    props = {p.name: p.value for p in node.properties}
-
-    name = props.get('name', '<unnamed>')
-    s = space + '+- [' + name + ']\n'
-
-    for k, v in props.items():
-        s += space + leader + ' ' + k + ': ' + dump_value(k, v) + '\n'
-
-    if node.children:
-        s += space + '\\_,\n'
-        for i, child in enumerate(node.children, start=1):
-            s += dump(child, depth=depth + 1, last=i == len(node.children))
-
-    return s
-
+class DeviceTreeIndex:
+    """
+    lookup tables over a device tree, built in a single walk: paths, property names,
+    name/compatible values and phandles. It is not updated when the tree is modified, so build a new one then.
+    """
+
+    VALUE_PROPERTIES = ('name', 'compatible')
+    PHANDLE_PROPERTIES = ('AAPL,phandle', 'phandle', 'linux,phandle')
+
+    def __init__(self, root):
+        self.root = root
+        self.paths = {}
+        self.by_property = {}
+        self.by_value = {}
+        self.phandles = {}
+        self._props = {}
+        self._parents = {}
+
+        stack = [(None, None, root)]
+        while stack:
+            parent_path, parent, node = stack.pop()
+            props = {p.name: p for p in node.properties}
+            self._props[id(node)] = props
+            self._parents[id(node)] = parent
+            path = () if parent_path is None else parent_path + (props['name'].value,)
+            self.paths.setdefault(path, []).append(node)
+
+            for k in props:
+                self.by_property.setdefault(k, []).append((path, node))
+            for k in self.VALUE_PROPERTIES:
+                if k in props:
+                    for v in self._value_keys(props[k].value):
+                        self.by_value.setdefault((k, v), []).append((path, node))
+            for k in self.PHANDLE_PROPERTIES:
+                if k in props:
+                    self.phandles.setdefault(props[k].value, node)
+
+            stack.extend((path, node, c) for c in reversed(node.children))
+
+    @staticmethod
+    def _value_keys(value):
+        """ hashable keys a value can be found under: string lists match as a whole and by each entry """
+        if isinstance(value, list):
+            return [tuple(value)] + list(dict.fromkeys(value))
+        return [value]
+
+    def props(self, node):
+        """ return a {name: property} dict for node """
+        return self._props[id(node)]
+
+    def node(self, path):
+        """ return the first node at path (a sequence of names below the root), or None """
+        nodes = self.paths.get(tuple(path))
+        return nodes[0] if nodes else None
+
+    def phandle(self, handle):
+        """ return the node with the given phandle, or None """
+        return self.phandles.get(handle)
+
+    def get(self, path):
+        """ return the properties and nodes named path[-1] under the nodes at path[:-1], like get() """
+        path = tuple(path)
+        if not path:
+            return []
+        children = self.paths.get(path, [])
+        results = []
+        for parent in self.paths.get(path[:-1], []):
+            prop = self._props[id(parent)].get(path[-1])
+            if prop is not None:
+                results.append(prop)
+            results.extend(c for c in children if self._parents[id(c)] is parent)
+        return results
+
+    def get_many(self, paths):
+        """ look up many paths at once, returning {path: results} """
+        return {tuple(path): self.get(path) for path in paths}
+
+    def find(self, pname, pvalue):
+        """ return the paths of all nodes whose pname property equals (or, for string lists, contains) pvalue """
+        if pname in self.VALUE_PROPERTIES:
+            key = tuple(pvalue) if isinstance(pvalue, list) else pvalue
+            return [path for path, _ in self.by_value.get((pname, key), [])]
+        results = []
+        for path, node in self.by_property.get(pname, []):
+            if matches(self._props[id(node)][pname].value, pvalue):
+                results.append(path)
+        return results
+
+
+
+WRITE_BUFFER_SIZE = 1 << 16
+
+def write_chunks(chunks, outfile, buffer_size=WRITE_BUFFER_SIZE):
+    """ write an iterable of strings to outfile, joined into writes of about buffer_size characters """
+    pending = []
+    size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        size += len(chunk)
+        if size >= buffer_size:
+            outfile.write(''.join(pending))
+            pending.clear()
+            size = 0
+    if pending:
+        outfile.write(''.join(pending))
 
-def get(node, path):
-    results = []
 
-    if len(path) == 1:
-        props = {p.name: p for p in node.properties}
-        if path[0] in props:
-            results.append(props[path[0]])
-
-    for c in node.children:
-        props = {p.name: p.value for p in c.properties}
-        if props['name'] == path[0]:
-            if len(path) == 1:
-                results.append(c)
-            else:
-                results.extend(get(c, path[1:]))
+def dump_value(n, v):
+    return restruct.format_value(v, str)
 
-    return results
+def iter_dump(events, depth=0, last=True):
+    """ yield dump() output for tree events, buffering at most the properties of one node per level """
+    stack = []
+    pending = None
+
+    def flush(frame, leader, children):
+        space = ' ' * (frame['depth'] * 2)
+        props = frame['props']
+        name = props['name'].value if 'name' in props else '<unnamed>'
+        yield space + '+- [' + name + ']\n'
+        for k, p in props.items():
+            yield space + leader + ' ' + k + ': ' + dump_value(k, p.value) + '\n'
+        if children:
+            yield space + '\\_,\n'
+        frame['props'] = None
+
+    for event, value in events:
+        if event == BEGIN_NODE:
+            # a sibling follows the pending node, and the parent turns out to have children
+            if pending:
+                yield from flush(pending, '|   ', False)
+                pending = None
+            if stack and stack[-1]['props'] is not None:
+                yield from flush(stack[-1], '|   ', True)
+            stack.append({'depth': depth + len(stack), 'props': {}})
+        elif event == PROPERTY:
+            stack[-1]['props'][value.name] = value
+        elif event == END_NODE:
+            if pending:
+                yield from flush(pending, '    ', False)
+                pending = None
+            frame = stack.pop()
+            if frame['props'] is not None:
+                pending = frame
+            if not stack:
+                break
+    if pending:
+        yield from flush(pending, '    ' if last else '|   ', False)
 
+def dump(node, depth=0, last=True):
+    return ''.join(iter_dump(iter_tree_events(node), depth=depth, last=last))
+
+
+def get(node, path, index=None):
+    """ look up path below node; pass a DeviceTreeIndex of the tree to reuse it over many lookups """
+    if index is None:
+        index = DeviceTreeIndex(node)
+    return index.get(path)
+
+
+BEGIN_NODE = 'begin_node'
+PROPERTY = 'property'
+END_NODE = 'end_node'
+
+def node_name(properties):
+    """ return the value of the (last) name property, or None """
+    name = None
+    for p in properties:
+        if p.name == 'name':
+            name = p.value
+    return name
+
+def iter_tree_events(node):
+    """ yield (BEGIN_NODE, name), (PROPERTY, property) and (END_NODE, name) events for an in-memory tree """
+    stack = [(node, None)]
+    while stack:
+        node, children = stack.pop()
+        if children is None:
+            yield BEGIN_NODE, node_name(node.properties)
+            for p in node.properties:
+                yield PROPERTY, p
+            children = iter(node.children)
+        child = next(children, None)
+        if child is None:
+            yield END_NODE, node_name(node.properties)
+        else:
+            stack.append((node, children))
+            stack.append((child, None))
+
+def iter_fdt_node_events(nodes, depth=0):
+    """ yield tree events for a parsed FDTNodeArray, up to the end of its first node """
+    names = []
+    for token in nodes:
+        if token.token == FDTToken.NodeBegin:
+            name = token.data
+            if depth == 0 and not names and not name:
+                name = 'device-tree'
+            names.append(name)
+            yield BEGIN_NODE, name
+            yield PROPERTY, ADTProperty(name='name', template=False, value=name)
+        elif token.token == FDTToken.Property:
+            yield PROPERTY, ADTProperty(name=token.data.name, template=False, value=token.data.data)
+        elif token.token == FDTToken.NodeEnd:
+            yield END_NODE, names.pop()
+            if not names:
+                return
+
+def iter_fdt_events(buf):
+    """ yield tree events for a flattened device tree straight from buf (e.g. an mmap), without building a tree """
+    if not hasattr(buf, 'find'):
+        # memoryview and friends can't search for terminators in place
+        buf = bytes(buf)
+    (magic, size, structs_offset, strings_offset, mem_offset, version, compat_version,
+        boot_cpu_id, strings_size, structs_size) = FDT_HEADER.unpack_from(buf)
+    if magic != FDT_MAGIC:
+        raise ValueError('not a flattened device tree')
+    structs_end = min(structs_offset + structs_size, len(buf))
+    strings_end = min(strings_offset + strings_size, len(buf))
+
+    # property names repeat a lot: decode each string offset once
+    names = {}
+    unpack_token = struct.Struct('>I').unpack_from
+    unpack_property = struct.Struct('>II').unpack_from
+    begin_token, end_node_token, property_token, ignore_token, end_token = (t.value for t in (
+        FDTToken.NodeBegin, FDTToken.NodeEnd, FDTToken.Property, FDTToken.Ignore, FDTToken.End,
+    ))
+
+    stack = []
+    pos = structs_offset
+    while pos + 4 <= structs_end:
+        token, = unpack_token(buf, pos)
+        pos += 4
+        if token == begin_token:
+            end = buf.find(b'\x00', pos, structs_end)
+            if end < 0:
+                break
+            name = buf[pos:end].decode()
+            pos = structs_offset + ((end - structs_offset + 4) & ~3)
+            if not stack:
+                name = name or 'device-tree'
+            stack.append(name)
+            yield BEGIN_NODE, name
+            yield PROPERTY, ADTProperty(name='name', template=False, value=name)
+        elif token == property_token:
+            if pos + 8 > structs_end:
+                break
+            length, name_offset = unpack_property(buf, pos)
+            pos += 8
+            name = names.get(name_offset)
+            if name is None:
+                start = strings_offset + name_offset
+                end = buf.find(b'\x00', start, strings_end)
+                if end < 0:
+                    raise ValueError('property name at strings offset {:#x} is unterminated'.format(name_offset))
+                name = names[name_offset] = buf[start:end].decode()
+            if pos + length > structs_end:
+                break
+            data = buf[pos:pos + length]
+            pos = structs_offset + ((pos - structs_offset + length + 3) & ~3)
+            value = decode_value(determine_type(name, data), data, 'big')
+            yield PROPERTY, ADTProperty(name=name, template=False, value=value)
+        elif token == end_node_token:
+            yield END_NODE, stack.pop()
+            if not stack:
+                return
+        elif token == end_token:
+            break
+        elif token != ignore_token:
+            raise ValueError('unknown FDT token {:#x} at offset {:#x}'.format(token, pos - 4))
 
-def from_fdt(nodes, depth=0):
-    node = ADTNode(property_count=0, properties=[], child_count=0, children=[])
+    raise ValueError('truncated flattened device tree')
 
-    assert nodes[0].token == FDTToken.NodeBegin
-    if depth == 0 and not nodes[0].data:
-        name = 'device-tree'
-    else:
-        name = nodes[0].data
-    node.properties.append(ADTProperty(name='name', template=False, value=name))
+def iter_adt_events(buf):
+    """ yield tree events for an Apple device tree straight from buf (e.g. an mmap), with lazily decoded property values """
+    unpack_node = ADT_NODE_HEADER.unpack_from
+    unpack_property = ADT_PROPERTY_HEADER.unpack_from
+    names = {}
 
-    i = 1
+    stack = []
+    pos = 0
     while True:
-        if nodes[i].token == FDTToken.NodeEnd:
-            break
-        elif nodes[i].token == FDTToken.NodeBegin:
-            n, child = from_fdt(nodes[i:], depth=depth + 1)
-            i += n
-            node.children.append(child)
-        elif nodes[i].token == FDTToken.Property:
-            k = nodes[i].data.name
-            v = nodes[i].data.data
-            node.properties.append(ADTProperty(name=k, template=False, value=v))
-        i += 1
-
-    node.property_count = len(node.properties)
-    node.child_count = len(node.children)
-    return i, node
+        try:
+            property_count, child_count = unpack_node(buf, pos)
+            pos += ADT_NODE_HEADER.size
+            properties = []
+            for _ in range(property_count):
+                raw_name, size = unpack_property(buf, pos)
+                pos += ADT_PROPERTY_HEADER.size
+                name = names.get(raw_name)
+                if name is None:
+                    name = names[raw_name] = raw_name.split(b'\x00', 1)[0].decode()
+                template = bool(size & 0x80000000)
+                size &= 0x7FFFFFFF
+                if pos + size > len(buf):
+                    raise ValueError('property {} at offset {:#x} exceeds buffer'.format(name, pos))
+                properties.append(LazyADTProperty(name, template, buf, pos, pos + size))
+                pos = (pos + size + 3) & ~3
+        except struct.error:
+            raise ValueError('truncated Apple device tree at offset {:#x}'.format(pos))
+
+        name = node_name(properties)
+        yield BEGIN_NODE, name
+        for p in properties:
+            yield PROPERTY, p
+        if child_count:
+            stack.append([name, child_count])
+            continue
+
+        yield END_NODE, name
+        while stack:
+            stack[-1][1] -= 1
+            if stack[-1][1]:
+                break
+            yield END_NODE, stack.pop()[0]
+        if not stack:
+            return
+
+def iter_events(buf):
+    """ yield tree events for an FDT or ADT in buf """
+    if buf[:len(FDT_MAGIC)] == FDT_MAGIC:
+        return iter_fdt_events(buf)
+    return iter_adt_events(buf)
+
+def build_tree(events):
+    """ build an ADTNode tree from tree events, returning the first complete root node """
+    stack = []
+    for event, value in events:
+        if event == BEGIN_NODE:
+            node = ADTNode(property_count=0, properties=[], child_count=0, children=[])
+            if stack:
+                stack[-1].children.append(node)
+            stack.append(node)
+        elif event == PROPERTY:
+            stack[-1].properties.append(value)
+        elif event == END_NODE:
+            node = stack.pop()
+            node.property_count = len(node.properties)
+            node.child_count = len(node.children)
+            if not stack:
+                return node
+    raise ValueError('incomplete device tree')
 
 
-def to_fdt(node, depth=0):
-    raise NotImplementedError
+def from_fdt(nodes, depth=0):
+    """ build an ADTNode tree from a parsed FDTNodeArray, returning (index of its closing token, node) """
+    consumed = 0
+    def tokens():
+        nonlocal consumed
+        for token in nodes:
+            consumed += 1
+            yield token
+    node = build_tree(iter_fdt_node_events(tokens(), depth=depth))
+    return consumed - 1, node
+
+def parse_fdt(buf):
+    """ parse a flattened device tree straight from buf into the same ADTNode tree as from_fdt() """
+    return build_tree(iter_fdt_events(buf))
+
+def load_adt(buf):
+    """ parse an Apple device tree from buf (e.g. an mmap), leaving property values undecoded until accessed """
+    return build_tree(iter_adt_events(buf))
+
+
+def fdt_strings(names):
+    """ build a strings block for names, storing names that are a suffix of another name only once """
+    offsets = {}
+    block = bytearray()
+    prev = None
+    # sorted by reversed name, every name directly follows the names it is a suffix of
+    for name in sorted((n.encode() for n in names), key=lambda n: n[::-1], reverse=True):
+        if prev is not None and prev.endswith(name):
+            offsets[name.decode()] = offsets[prev.decode()] + len(prev) - len(name)
+        else:
+            offsets[name.decode()] = len(block)
+            block += name + b'\x00'
+        prev = name
+    return offsets, block
+
+def to_fdt(node, reservations=()):
+    """ convert a device tree to a flattened device tree blob """
+    # walk the tree once, encoding values and sizing the structs block
+    ops = []
+    names = set()
+    structs_size = 4
+    stack = [(node, True)]
+    while stack:
+        n, begin = stack.pop()
+        if not begin:
+            ops.append(None)
+            structs_size += 4
+            continue
+        name = ''
+        props = []
+        for p in n.properties:
+            if p.name == 'name':
+                name = p.value
+                continue
+            data = encode_value(determine_reverse_type(p.name, p.value), p.value, 'big')
+            props.append((p.name, data))
+            names.add(p.name)
+            structs_size += 12 + ((len(data) + 3) & ~3)
+        name = (name if n is not node else '').encode()
+        ops.append((name, props))
+        structs_size += 4 + ((len(name) + 4) & ~3)
+        stack.append((n, False))
+        stack.extend((c, True) for c in reversed(n.children))
+
+    offsets, strings = fdt_strings(names)
+    mem_offset = FDT_HEADER.size
+    structs_offset = mem_offset + 16 * (len(reservations) + 1)
+    strings_offset = structs_offset + structs_size
+    size = strings_offset + len(strings)
+
+    buf = bytearray(size)
+    FDT_HEADER.pack_into(buf, 0, FDT_MAGIC, size, structs_offset, strings_offset, mem_offset, 17, 16, 0, len(strings), structs_size)
+    for i, (address, length) in enumerate(reservations):
+        struct.pack_into('>QQ', buf, mem_offset + 16 * i, address, length)
+
+    pos = structs_offset
+    begin_token, end_node_token, property_token, end_token = (t.value for t in (
+        FDTToken.NodeBegin, FDTToken.NodeEnd, FDTToken.Property, FDTToken.End,
+    ))
+    for op in ops:
+        if op is None:
+            struct.pack_into('>I', buf, pos, end_node_token)
+            pos += 4
+            continue
+        name, props = op
+        struct.pack_into('>I', buf, pos, begin_token)
+        buf[pos + 4:pos + 4 + len(name)] = name
+        pos += 4 + ((len(name) + 4) & ~3)
+        for k, data in props:
+            struct.pack_into('>III', buf, pos, property_token, len(data), offsets[k])
+            buf[pos + 12:pos + 12 + len(data)] = data
+            pos += 12 + ((len(data) + 3) & ~3)
+    struct.pack_into('>I', buf, pos, end_token)
+    buf[strings_offset:] = strings
+    return buf
+
+
+def to_adt(node):
+    """ convert a device tree to an Apple device tree blob """
+    # walk the tree once to encode values and size the output
+    ops = []
+    size = 0
+    stack = [node]
+    while stack:
+        n = stack.pop()
+        props = []
+        for p in n.properties:
+            name = p.name.encode()
+            if len(name) >= 32:
+                raise ValueError('property name {} is too long for an Apple device tree'.format(p.name))
+            # undecoded values can be copied as-is
+            data = getattr(p, 'raw', None)
+            if data is None:
+                data = encode_value(determine_reverse_type(p.name, p.value), p.value, 'little')
+            props.append((name, bool(p.template), data))
+            size += ADT_PROPERTY_HEADER.size + ((len(data) + 3) & ~3)
+        ops.append((len(n.children), props))
+        size += ADT_NODE_HEADER.size
+        stack.extend(reversed(n.children))
+
+    buf = bytearray(size)
+    pos = 0
+    for child_count, props in ops:
+        ADT_NODE_HEADER.pack_into(buf, pos, len(props), child_count)
+        pos += ADT_NODE_HEADER.size
+        for name, template, data in props:
+            ADT_PROPERTY_HEADER.pack_into(buf, pos, name, len(data) | (0x80000000 if template else 0))
+            pos += ADT_PROPERTY_HEADER.size
+            buf[pos:pos + len(data)] = data
+            pos += (len(data) + 3) & ~3
+    return buf
 
 
 def value_to_dts(val):
@@ -258,98 +738,299 @@ def value_to_dts(val):
     if isinstance(val, bytes):
         return '[' + val.hex() + ']'
 
-def to_dts(node, depth=0):
-    s = ''
-    props = {p.name: p.value for p in node.properties}
-    spacing = ' ' * (depth * 2)
+def iter_dts(events, depth=0):
+    """ yield to_dts() output for tree events, buffering at most the properties of one node per level """
+    stack = []
+
+    def flush(frame):
+        d = frame['depth']
+        props = {k: p.value for k, p in frame['props'].items()}
+        name = props.pop('name')
+        if not d:
+            name = '/'
+        yield ' ' * (d * 2) + name + ' {\n'
+        for k, v in props.items():
+            p = k
+            sv = value_to_dts(v)
+            if sv is not None:
+                p += ' = ' + sv
+            yield restruct.indent(p + ';', count=(d + 1) * 2, start=True) + '\n'
+        frame['props'] = None
 
     if not depth:
-        s += '/dts-v1/;\n\n'
-
-    name = props.pop('name')
-    if not depth:
-        name = '/'
-    s += spacing + name + ' {\n'
-
-    for k, v in props.items():
-        p = k
-        sv = value_to_dts(v)
-        if sv is not None:
-            p += ' = ' + sv
-        s += restruct.indent(p + ';', count=(depth + 1) * 2, start=True) + '\n'
-
-    for c in node.children:
-        s += '\n' + to_dts(c, depth=depth + 1)
-
-    s += spacing + '};\n'
-
-    return s
+        yield '/dts-v1/;\n\n'
+    for event, value in events:
+        if event == BEGIN_NODE:
+            if stack:
+                if stack[-1]['props'] is not None:
+                    yield from flush(stack[-1])
+                yield '\n'
+            stack.append({'depth': depth + len(stack), 'props': {}})
+        elif event == PROPERTY:
+            stack[-1]['props'][value.name] = value
+        elif event == END_NODE:
+            frame = stack.pop()
+            if frame['props'] is not None:
+                yield from flush(frame)
+            yield ' ' * (frame['depth'] * 2) + '};\n'
+            if not stack:
+                break
 
+def to_dts(node, depth=0):
+    return ''.join(iter_dts(iter_tree_events(node), depth=depth))
+
+
+DTS_TOKEN = re.compile(r'''
+    (?P<skip>\s+|//[^\n]*|/\*.*?\*/)
+  | (?P<string>"[^"\\]*(?:\\.[^"\\]*)*")
+  | (?P<unterminated>")
+  | (?P<cells><[^>]*>)
+  | (?P<bytes>\[[^\]]*\])
+  | (?P<punct>[{};=]|,(?![^\s{};=<>"\[\]]))
+  | (?P<name>[^\s{};=<>"\[\]]+)
+  | (?P<error>.)
+''', re.VERBOSE | re.DOTALL)
+
+def parse_dts(text, order='little'):
+    """
+    parse device tree source, in the subset that to_dts() writes, into an ADTNode tree.
+    Cell lists with more than one cell become bytes in the given byte order.
+    """
+    # lex everything in one pass; no alternative backtracks more than linearly, even on an unterminated string
+    toks = [(m.lastgroup, m.group(), m.start()) for m in DTS_TOKEN.finditer(text) if m.lastgroup != 'skip']
+    toks.append(('end', '', len(text)))
+
+    def error(i, msg):
+        kind, tok, pos = toks[i]
+        if kind == 'error':
+            msg = 'unexpected {!r}'.format(tok)
+        elif kind == 'unterminated':
+            msg = 'unterminated string'
+        elif kind == 'end':
+            msg = 'unexpected end of input'
+        raise ValueError('line {}: {}'.format(text.count('\n', 0, pos) + 1, msg))
+
+    def value(i, depth):
+        kind, tok, _ = toks[i]
+        if kind == 'string':
+            s = tok[1:-1].replace('\\"', '"')
+            # undo the indentation to_dts() adds to continuation lines
+            return s.replace('\n' + ' ' * (depth * 2), '\n') if '\n' in s else s
+        if kind == 'cells':
+            try:
+                cells = [int(x, 0) for x in tok[1:-1].split()]
+            except ValueError:
+                error(i, 'invalid cell value')
+            if len(cells) == 1:
+                return cells[0]
+            return b''.join(x.to_bytes(4, order) for x in cells)
+        if kind == 'bytes':
+            try:
+                return bytes.fromhex(tok[1:-1])
+            except ValueError:
+                error(i, 'invalid byte string')
+        error(i, 'expected a value')
+
+    i = 0
+    if toks[0][1] == '/dts-v1/':
+        if toks[1][1] != ';':
+            error(1, "expected ';'")
+        i = 2
+
+    root = None
+    stack = []
+    while True:
+        kind, tok, _ = toks[i]
+        if tok == '}' and stack:
+            if toks[i + 1][1] != ';':
+                error(i + 1, "expected ';'")
+            i += 2
+            node = stack.pop()
+            node.property_count = len(node.properties)
+            node.child_count = len(node.children)
+            if not stack:
+                break
+            continue
+        if kind != 'name':
+            error(i, 'expected a name')
+
+        after = toks[i + 1][1]
+        if after == '{':
+            if not stack and tok == '/':
+                tok = 'device-tree'
+            node = ADTNode(property_count=0, properties=[ADTProperty(name='name', template=False, value=tok)], child_count=0, children=[])
+            if stack:
+                stack[-1].children.append(node)
+            else:
+                root = node
+            stack.append(node)
+            i += 2
+        elif after == ';' and stack:
+            stack[-1].properties.append(ADTProperty(name=tok, template=False, value=None))
+            i += 2
+        elif after == '=' and stack:
+            j = i + 2
+            values = []
+            if toks[j][1] != ';':
+                while True:
+                    values.append(value(j, len(stack)))
+                    j += 1
+                    if toks[j][1] != ',':
+                        break
+                    j += 1
+            if toks[j][1] != ';':
+                error(j, "expected ';'")
+            if len(values) == 1 and not (isinstance(values[0], str) and PROPERTY_TYPES.get(tok) == DeviceTreeType.StringList):
+                v = values[0]
+            elif all(isinstance(x, str) for x in values):
+                v = values
+            else:
+                v = b''.join(encode_value(determine_reverse_type(tok, x), x, order) for x in values)
+            stack[-1].properties.append(ADTProperty(name=tok, template=False, value=v))
+            i = j + 1
+        else:
+            error(i + 1, 'unexpected {!r}'.format(after))
+
+    if toks[i][0] != 'end':
+        error(i, 'trailing data after root node')
+    return root
+
+
+def tree_hashes(root):
+    """ return {id(node): digest} of every node's properties and, recursively, its children """
+    order = []
+    stack = [root]
+    while stack:
+        n = stack.pop()
+        order.append(n)
+        stack.extend(n.children)
+
+    hashes = {}
+    pack = struct.Struct('<II').pack
+    # descendants come before their ancestors in reversed pre-order
+    for n in reversed(order):
+        parts = []
+        for k, p in {p.name: p for p in n.properties}.items():
+            # undecoded values hash their raw bytes, which saves decoding them
+            raw = getattr(p, 'raw', None)
+            data = b'r' + raw if raw is not None else b'v' + repr(p.value).encode()
+            k = k.encode()
+            parts.append(pack(len(k), len(data)) + k + data)
+        parts.extend(hashes[id(c)] for c in n.children)
+        hashes[id(n)] = hashlib.blake2b(b''.join(parts), digest_size=16).digest()
+    return hashes
 
 def diff(a, b, path=[]):
-    diffs = {tuple(path): None}
-    a_props = {p.name: p.value for p in a.properties} if a else {}
-    b_props = {p.name: p.value for p in b.properties} if b else {}
-
-    premoved = []
-    padded = []
-    for k in a_props:
-        if k not in b_props:
-            premoved.append((k, a_props[k]))
-        else:
-            if a_props[k] != b_props[k]:
+    """
+    compare two device trees, returning {path: (removed props, added props, removed children, added children)}
+    for the root and every pair of matched nodes that differ. Subtrees with equal hashes are skipped entirely;
+    children are matched by hash first, and by name after that.
+    """
+    a_hashes = tree_hashes(a) if a else {}
+    b_hashes = tree_hashes(b) if b else {}
+    diffs = {}
+
+    stack = [(a, b, tuple(path))]
+    while stack:
+        a, b, path = stack.pop()
+        a_props = {p.name: p.value for p in a.properties} if a else {}
+        b_props = {p.name: p.value for p in b.properties} if b else {}
+
+        premoved = []
+        padded = []
+        for k in a_props:
+            if k not in b_props:
                 premoved.append((k, a_props[k]))
-                padded.append((k, b_props[k]))
-            del b_props[k]
-
-    for k in b_props:
-        padded.append((k, b_props[k]))
-
-    b_children = {}
-    for c in (b.children if b else []):
-        name = next(p.value for p in c.properties if p.name == 'name')
-        b_children.setdefault(name, []).append(c)
-
-    cremoved = []
-    cadded = []
-    for c in (a.children if a else []):
-        props = {p.name: p.value for p in c.properties}
-        name = props['name']
-        if name not in b_children:
-            cremoved.append(c)
-        else:
-            diffs.update(diff(c, b_children[name].pop(0), path + [name]))
+            else:
+                if a_props[k] != b_props[k]:
+                    premoved.append((k, a_props[k]))
+                    padded.append((k, b_props[k]))
+                del b_props[k]
+
+        for k in b_props:
+            padded.append((k, b_props[k]))
+
+        a_children = a.children if a else []
+        b_children = b.children if b else []
+        matched = set()
+
+        # identical children need no further comparison
+        b_same = {}
+        for c in b_children:
+            b_same.setdefault(b_hashes[id(c)], collections.deque()).append(c)
+        a_rest = []
+        for c in a_children:
+            same = b_same.get(a_hashes[id(c)])
+            if same:
+                matched.add(id(same.popleft()))
+            else:
+                a_rest.append(c)
+
+        b_names = {}
+        for c in b_children:
+            if id(c) not in matched:
+                b_names.setdefault(node_name(c.properties), collections.deque()).append(c)
+        cremoved = []
+        pairs = []
+        for c in a_rest:
+            name = node_name(c.properties)
+            other = b_names.get(name)
+            if other:
+                o = other.popleft()
+                matched.add(id(o))
+                pairs.append((c, o, path + (name,)))
+            else:
+                cremoved.append(c)
+        cadded = [c for c in b_children if id(c) not in matched]
 
-    for name, cs in b_children.items():
-        for c in cs:
-            cadded.append(c)
+        diffs[path] = (premoved, padded, cremoved, cadded)
+        stack.extend(reversed(pairs))
 
-    diffs[tuple(path)] = (premoved, padded, cremoved, cadded)
     return diffs
 
 
-def find(node, pname, pvalue, path=[]):
-    results = []
-    props = {p.name: p.value for p in node.properties}
-
-    nname = props['name']
-    if props.get(pname, None) == pvalue:
-        results.append(path + [nname])
-
-    for c in node.children:
-        results.extend(find(c, pname, pvalue, path + [nname]))
+def matches(value, pvalue):
+    return value == pvalue or (isinstance(value, list) and pvalue in value)
+
+def iter_find(events, pname, pvalue):
+    """ yield the path (list of names, including the root) of every node whose pname property matches pvalue """
+    path = []
+    # whether the innermost node matches, while its properties are still coming in
+    matched = None
+    for event, value in events:
+        if event == BEGIN_NODE:
+            if matched:
+                yield list(path)
+            matched = False
+            path.append(value)
+        elif event == PROPERTY:
+            if value.name == pname:
+                matched = matches(value.value, pvalue)
+        elif event == END_NODE:
+            if matched:
+                yield list(path)
+            matched = None
+            path.pop()
+            if not path:
+                break
 
-    return results
+def find(node, pname, pvalue, path=[], index=None):
+    if index is None:
+        index = DeviceTreeIndex(node)
+    root = path + [index.props(node)['name'].value]
+    return [root + list(p) for p in index.find(pname, pvalue)]
 
 
-def regs(node, path):
+def regs(node, path, index=None):
+    if index is None:
+        index = DeviceTreeIndex(node)
     path = path[:]
     addrspaces = []
     last_addr_size = None
     last_size_size = None
 
     while True:
-        props = {p.name: p.value for p in node.properties}
+        props = {k: p.value for k, p in index.props(node).items()}
 
         if '#address-cells' in props and '#size-cells' in props:
             this_addr_size = props['#address-cells']
@@ -370,9 +1051,7 @@ def regs(node, path):
             break
 
         for child in node.children:
-            cprops = {p.name: p.value for p in child.properties}
-            cname = cprops['name']
-            if cname == path[0]:
+            if index.props(child)['name'].value == path[0]:
                 path.pop(0)
                 node = child
                 break
@@ -397,26 +1076,372 @@ def regs(node, path):
     return rs
 
 
+class AddressRanges:
+    """
+    the ranges of one node as an interval lookup: sorted by child address, with a running maximum of
+    range ends so lookups only look at ranges that can still contain the address
+    """
+
+    def __init__(self, ranges):
+        # (child address, child end, parent address, original position)
+        self.ranges = sorted((c, c + l, p, i) for i, (c, p, l) in enumerate(ranges))
+        self.starts = [r[0] for r in self.ranges]
+        self.max_ends = list(itertools.accumulate((r[1] for r in self.ranges), max))
+
+    def __bool__(self):
+        return bool(self.ranges)
+
+    def translate(self, addr, length):
+        """ map [addr, addr + length) to the parent address space, or return None if no range contains it """
+        best = None
+        i = bisect.bisect_right(self.starts, addr) - 1
+        while i >= 0 and self.max_ends[i] >= addr + length:
+            c, end, p, pos = self.ranges[i]
+            if end >= addr + length and (best is None or pos < best[1]):
+                best = (p + addr - c, pos)
+            i -= 1
+        return best[0] if best else None
+
+def _raw_value(p):
+    raw = getattr(p, 'raw', None)
+    if raw is not None:
+        return raw
+    return encode_value(determine_reverse_type(p.name, p.value), p.value, 'little')
+
+def _parse_cells(data, sizes):
+    """ split data into tuples of little-endian integers of the given byte sizes """
+    step = sum(sizes)
+    entries = []
+    for pos in range(0, len(data) - step + 1, step):
+        entry = []
+        for size in sizes:
+            entry.append(int.from_bytes(data[pos:pos + size], 'little'))
+            pos += size
+        entries.append(entry)
+    return entries
+
+def iter_all_regs(node):
+    """
+    walk the tree once, yielding (path, address, length) for every reg entry of every node, translated to the root
+    address space like regs() does; address is None if the entry cannot be mapped. Every ranges property is only
+    parsed once, and shared by all nodes below it.
+    """
+    stack = [((), node, None, None, ())]
+    while stack:
+        path, node, addr_size, size_size, addrspaces = stack.pop()
+        props = {p.name: p for p in node.properties}
+
+        if '#address-cells' in props and '#size-cells' in props:
+            this_addr_size = props['#address-cells'].value * 4
+            this_size_size = props['#size-cells'].value * 4
+            if 'ranges' in props and addr_size is not None:
+                ranges = _parse_cells(_raw_value(props['ranges']), (this_addr_size, addr_size, this_size_size))
+                addrspaces += (AddressRanges(ranges),)
+            addr_size = this_addr_size
+            size_size = this_size_size
+
+        if 'reg' in props and addr_size is not None:
+            for addr, length in _parse_cells(_raw_value(props['reg']), (addr_size, size_size)):
+                for addrspace in reversed(addrspaces):
+                    if addrspace:
+                        addr = addrspace.translate(addr, length)
+                        if addr is None:
+                            break
+                yield path, addr, length
+
+        for child in reversed(node.children):
+            stack.append((path + (node_name(child.properties),), child, addr_size, size_size, addrspaces))
+
+def find_overlaps(regs):
+    """ given (path, address, length) entries, return all pairs of entries from different nodes whose ranges overlap """
+    entries = sorted((r for r in regs if r[1] is not None and r[2]), key=lambda r: r[1])
+    overlaps = []
+    active = []
+    for n, entry in enumerate(entries):
+        path, addr, length = entry
+        while active and active[0][0] <= addr:
+            heapq.heappop(active)
+        for _, i in active:
+            if entries[i][0] != path:
+                overlaps.append((entries[i], entry))
+        heapq.heappush(active, (addr + length, n))
+    return overlaps
+
+
+CORPUS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id    INTEGER PRIMARY KEY,
+    path  TEXT UNIQUE NOT NULL,
+    mtime INTEGER NOT NULL,
+    size  INTEGER NOT NULL,
+    root  BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    hash       BLOB PRIMARY KEY,
+    properties BLOB NOT NULL,
+    children   BLOB NOT NULL
+) WITHOUT ROWID;
+"""
+
+def open_corpus(path):
+    """ open (and create if needed) a SQLite store of deduplicated device tree subtrees """
+    import sqlite3
+    db = sqlite3.connect(path)
+    db.executescript(CORPUS_SCHEMA)
+    return db
+
+def iter_corpus_paths(source):
+    """ yield the files in source, recursively if it is a directory """
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                yield os.path.join(root, name)
+    else:
+        yield source
+
+def dump_properties(node):
+    """ return the properties of a node as marshallable (name, template, is raw, raw bytes or value) tuples """
+    props = []
+    for p in node.properties:
+        # undecoded values are stored raw, and stay lazy when loaded again
+        raw = getattr(p, 'raw', None)
+        props.append((p.name, bool(p.template), raw is not None, raw if raw is not None else p.value))
+    return props
+
+def load_properties(props):
+    """ inverse of dump_properties() """
+    return [
+        LazyADTProperty(name, template, value, 0, len(value)) if raw else ADTProperty(name=name, template=template, value=value)
+        for name, template, raw, value in props
+    ]
+
+def corpus_records(root):
+    """ return (root hash, [(hash, properties, children)]) for every unique subtree of a tree, serialized for the corpus store """
+    import marshal
+
+    hashes = tree_hashes(root)
+    records = {}
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        digest = hashes[id(node)]
+        if digest in records:
+            continue
+        children = [(node_name(c.properties), hashes[id(c)]) for c in node.children]
+        records[digest] = (digest, marshal.dumps(dump_properties(node)), marshal.dumps(children))
+        stack.extend(node.children)
+    return hashes[id(root)], list(records.values())
+
+def _corpus_worker(path):
+    try:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return path, corpus_records(build_tree(iter_events(m)))
+    except Exception as e:
+        return path, e
+
+def update_corpus(db, paths, jobs=None):
+    """
+    parse the given device tree files and directories over a process pool and add their subtrees to the corpus,
+    skipping files whose mtime and size did not change: returns (added, unchanged, failed) counts.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    counts = collections.Counter()
+    todo = {}
+    for source in paths:
+        for p in iter_corpus_paths(source):
+            p = os.path.abspath(p)
+            try:
+                st = os.stat(p)
+            except OSError:
+                counts['failed'] += 1
+                continue
+            row = db.execute('SELECT mtime, size FROM files WHERE path = ?', (p,)).fetchone()
+            if row == (st.st_mtime_ns, st.st_size):
+                counts['unchanged'] += 1
+            else:
+                todo[p] = st
+
+    with db, ProcessPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as pool:
+        for p, result in pool.map(_corpus_worker, todo, chunksize=4):
+            if isinstance(result, Exception):
+                counts['failed'] += 1
+                continue
+            root, records = result
+            db.executemany('INSERT OR IGNORE INTO nodes (hash, properties, children) VALUES (?, ?, ?)', records)
+            db.execute('INSERT OR REPLACE INTO files (path, mtime, size, root) VALUES (?, ?, ?, ?)', (p, todo[p].st_mtime_ns, todo[p].st_size, root))
+            counts['added'] += 1
+    return counts['added'], counts['unchanged'], counts['failed']
+
+def load_corpus_node(db, digest):
+    """ rebuild the subtree with the given hash from the corpus as an ADTNode tree """
+    import marshal
+
+    def load(digest):
+        row = db.execute('SELECT properties, children FROM nodes WHERE hash = ?', (digest,)).fetchone()
+        if not row:
+            raise KeyError(digest)
+        props = load_properties(marshal.loads(row[0]))
+        node = ADTNode(property_count=len(props), properties=props, child_count=0, children=[])
+        return node, [h for _, h in marshal.loads(row[1])]
+
+    root, children = load(digest)
+    stack = [(root, children)]
+    while stack:
+        node, children = stack.pop()
+        for h in children:
+            child, grandchildren = load(h)
+            node.children.append(child)
+            stack.append((child, grandchildren))
+        node.child_count = len(node.children)
+    return root
+
+def corpus_variants(db, path):
+    """
+    group the files in the corpus by the subtree at path (a sequence of node names below the root):
+    returns {subtree hash: [file paths]}, with files that lack the node under None.
+    Every stored subtree is read at most once, however many files share it.
+    """
+    import marshal
+
+    child_maps = {}
+    def child(digest, name):
+        if digest not in child_maps:
+            children = {}
+            for n, h in marshal.loads(db.execute('SELECT children FROM nodes WHERE hash = ?', (digest,)).fetchone()[0]):
+                children.setdefault(n, h)
+            child_maps[digest] = children
+        return child_maps[digest].get(name)
+
+    resolved = {}
+    variants = {}
+    for file, root in db.execute('SELECT path, root FROM files ORDER BY path'):
+        if root not in resolved:
+            digest = root
+            for name in path:
+                digest = child(digest, name)
+                if digest is None:
+                    break
+            resolved[root] = digest
+        variants.setdefault(resolved[root], []).append(file)
+    return variants
+
+
+# bump whenever parsing or value typing changes, to invalidate cached trees
+PARSER_VERSION = 1
+
+def tree_cache_path(cache_dir, data):
+    """ return the path under cache_dir where the parsed tree for the given file contents is cached """
+    import marshal
+    digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+    return os.path.join(cache_dir, '{}-{}-{}.dtc'.format(digest, PARSER_VERSION, marshal.version))
+
+def dump_tree_cache(root):
+    """ serialize a tree for the cache as a flat pre-order list of (child count, properties) """
+    import marshal
+
+    records = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        records.append((len(node.children), dump_properties(node)))
+        stack.extend(reversed(node.children))
+    return marshal.dumps(records)
+
+def load_tree_cache(data):
+    """ inverse of dump_tree_cache() """
+    import gc
+    import marshal
+
+    root = None
+    stack = []
+    # the tree has no reference cycles, and collections triggered by its many small objects would dominate the load
+    paused = gc.isenabled()
+    gc.disable()
+    try:
+        for child_count, props in marshal.loads(data):
+            props = load_properties(props)
+            node = ADTNode(property_count=len(props), properties=props, child_count=child_count, children=[])
+            if stack:
+                parent = stack[-1]
+                parent.children.append(node)
+                if len(parent.children) == parent.child_count:
+                    stack.pop()
+            else:
+                root = node
+            if child_count:
+                stack.append(node)
+    finally:
+        if paused:
+            gc.enable()
+    if root is None or stack:
+        raise ValueError('truncated tree cache')
+    return root
+
+def load_cached_tree(data, cache_dir):
+    """ return the tree for the given device tree file contents, parsing and caching it in cache_dir on a miss """
+    path = tree_cache_path(cache_dir, data)
+    try:
+        with open(path, 'rb') as f:
+            return load_tree_cache(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    root = build_tree(iter_events(data))
+    # write under a temporary name so concurrent readers never see a partial file
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(tmp, 'wb') as f:
+            f.write(dump_tree_cache(root))
+        os.replace(tmp, path)
+    except OSError as e:
+        print('warning: could not write tree cache {}: {}'.format(path, e), file=sys.stderr)
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+    return root
+
+
 if __name__ == '__main__':
     def get_adt(infile):
+        if args.restruct:
+            try:
+                fdt = restruct.parse(FlattenedDeviceTree, infile)
+                _, adt = from_fdt(fdt.structs)
+                return adt
+            except:
+                infile.seek(0)
+                return restruct.parse(AppleDeviceTree, infile)
+        if args.cache:
+            return load_cached_tree(read_input(infile), args.cache)
+
+        return build_tree(get_events(infile))
+
+    def get_events(infile):
+        if args.restruct or args.cache:
+            return iter_tree_events(get_adt(infile))
+        return iter_events(read_input(infile))
+
+    def read_input(infile):
         try:
-            fdt = restruct.parse(FlattenedDeviceTree, infile)
-            _, adt = from_fdt(fdt.structs)
-            return adt
-        except:
-            infile.seek(0)
-            return restruct.parse(AppleDeviceTree, infile)
+            return mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return infile.read()
 
     import sys
     import argparse
 
     parser = argparse.ArgumentParser(description='process Apple (ADT) and Flattened (FDT) device tree files')
+    parser.add_argument('--restruct', action='store_true', help='parse through the generic restruct definitions instead of the fast parsers (for cross-checking)')
+    parser.add_argument('--cache', metavar='DIR', help='cache parsed trees in this directory, keyed by file contents')
     parser.set_defaults(func=None)
     subparsers = parser.add_subparsers(help='subcommand')
 
     def do_dump(args):
-        dt = get_adt(args.infile)
-        args.outfile.write(dump(dt))
+        write_chunks(iter_dump(get_events(args.infile)), args.outfile)
     dump_parser = subparsers.add_parser('dump', help='visually show device tree')
     dump_parser.add_argument('infile', type=argparse.FileType('rb'), help='input file')
     dump_parser.add_argument('outfile', type=argparse.FileType('w'), nargs='?', default=sys.stdout, help='output file')
@@ -424,29 +1449,31 @@ if __name__ == '__main__':
 
     def do_show(args):
         dt = get_adt(args.infile)
-        path = args.path.lstrip('/').split('/')
-        for value in get(dt, path):
-            if isinstance(value, ADTProperty):
-                print(dump_value(value.name, value.value))
-            else:
-                for p in value.properties:
-                    print(p.name + ': ' + dump_value(p.name, p.value))
+        results = DeviceTreeIndex(dt).get_many(path.lstrip('/').split('/') for path in args.path)
+        for path, values in results.items():
+            if len(results) > 1:
+                print('/' + '/'.join(path) + ':')
+            for value in values:
+                if isinstance(value, ADTProperty):
+                    print(dump_value(value.name, value.value))
+                else:
+                    for p in value.properties:
+                        print(p.name + ': ' + dump_value(p.name, p.value))
 
     show_parser = subparsers.add_parser('show', help='get value of property or node in device tree')
     show_parser.add_argument('infile', type=argparse.FileType('rb'), help='input file')
-    show_parser.add_argument('path', help='path to get')
+    show_parser.add_argument('path', nargs='+', help='path(s) to get')
     show_parser.set_defaults(func=do_show)
 
     def do_find(args):
-        dt = get_adt(args.infile)
         if '=' in args.property:
             pn, pv = args.property.split('=')
         else:
             pn = 'name'
             pv = args.property
-        for c in dt.children:
-            for p in find(c, pn, pv):
-                print('/' + '/'.join(p))
+        for p in iter_find(get_events(args.infile), pn, pv):
+            if len(p) > 1:
+                print('/' + '/'.join(p[1:]))
     find_parser = subparsers.add_parser('find', help='find node in device tree')
     find_parser.add_argument('infile', type=argparse.FileType('rb'), help='input file')
     find_parser.add_argument('property', help='name or property of node to find')
@@ -483,7 +1510,8 @@ if __name__ == '__main__':
             a = ap[0] if ap else None
             b = bp[0] if bp else None
 
-        diffs = diff(a, b)
+        print_diffs(diff(a, b))
+    def print_diffs(diffs):
         for path, (premoved, padded, cremoved, cadded) in diffs.items():
             if premoved or padded:
                 do_diff_props(padded, premoved, path)
@@ -497,20 +1525,69 @@ if __name__ == '__main__':
     diff_parser.add_argument('path', nargs='?', help='path to show differences for')
     diff_parser.set_defaults(func=do_diff)
 
+    def do_corpus(args):
+        db = open_corpus(args.database)
+        if args.add:
+            added, unchanged, failed = update_corpus(db, args.add, jobs=args.jobs)
+            files, = db.execute('SELECT COUNT(*) FROM files').fetchone()
+            nodes, = db.execute('SELECT COUNT(*) FROM nodes').fetchone()
+            print('{} added, {} unchanged, {} failed; {} files, {} unique subtrees'.format(added, unchanged, failed, files, nodes))
+
+        for path in args.path:
+            names = [n for n in path.strip('/').split('/') if n]
+            variants = corpus_variants(db, names)
+            print('/' + '/'.join(names) + ': {} variant(s)'.format(len(variants) - (None in variants)))
+            ordered = sorted(variants.items(), key=lambda x: (x[0] is None, -len(x[1])))
+            for digest, files in ordered:
+                print('  ' + (digest.hex() if digest else 'missing') + ' ({} file(s))'.format(len(files)))
+                for f in files:
+                    print('    ' + f)
+            if args.diff and ordered:
+                base = ordered[0][0]
+                for digest, files in ordered[1:]:
+                    print()
+                    print('# {} -> {}'.format(base.hex() if base else 'missing', digest.hex() if digest else 'missing'))
+                    a = load_corpus_node(db, base) if base else None
+                    b = load_corpus_node(db, digest) if digest else None
+                    print_diffs(diff(a, b, path=names))
+    corpus_parser = subparsers.add_parser('corpus', help='collect device trees into a deduplicated store and compare nodes across them')
+    corpus_parser.add_argument('-a', '--add', nargs='+', metavar='FILE', default=[], help='device tree files or directories to (re)parse into the store')
+    corpus_parser.add_argument('-j', '--jobs', type=int, help='number of parallel parsers (default: CPU count)')
+    corpus_parser.add_argument('-d', '--diff', action='store_true', help='show how each variant differs from the most common one')
+    corpus_parser.add_argument('database', help='store database file')
+    corpus_parser.add_argument('path', nargs='*', help='node paths to show the variants of (example: arm-io/i2c2)')
+    corpus_parser.set_defaults(func=do_corpus)
+
     def do_regs(args):
         dt = get_adt(args.infile)
-        path = args.path.lstrip('/').split('/')
-        for (addr, size) in regs(dt, path):
-            print(hex(addr), size)
+        if args.all:
+            regs = list(iter_all_regs(dt))
+            for path, addr, size in sorted(regs, key=lambda r: (r[1] is None, r[1] or 0)):
+                print('/' + '/'.join(path), hex(addr) if addr is not None else 'unmapped', size)
+            overlaps = find_overlaps(regs)
+            if overlaps:
+                print()
+                print('{} overlap(s):'.format(len(overlaps)))
+                for (apath, aaddr, asize), (bpath, baddr, bsize) in overlaps:
+                    print('/' + '/'.join(apath), hex(aaddr), asize, '<->', '/' + '/'.join(bpath), hex(baddr), bsize)
+            return
+        if not args.path:
+            regs_parser.error('a path or --all must be given')
+        index = DeviceTreeIndex(dt)
+        for path in args.path:
+            if len(args.path) > 1:
+                print(path + ':')
+            for (addr, size) in regs(dt, path.lstrip('/').split('/'), index=index):
+                print(hex(addr), size)
     regs_parser = subparsers.add_parser('regs', help='show calculated register ranges for given path')
+    regs_parser.add_argument('-a', '--all', action='store_true', help='show the register ranges of all nodes, and where they overlap')
     regs_parser.add_argument('infile', type=argparse.FileType('rb'), help='input file')
-    regs_parser.add_argument('path', help='path to the device node, nodes separated by \'/\' (example: arm-io/i2c2/audio-codec-output)')
+    regs_parser.add_argument('path', nargs='*', help='path(s) to the device node, nodes separated by \'/\' (example: arm-io/i2c2/audio-codec-output)')
     regs_parser.set_defaults(func=do_regs)
 
     def do_conv_fdt(args):
-        adt = restruct.parse(AppleDeviceTree, args.infile)
-        n, dt = to_fdt(adt)
-        restruct.emit(FlattenedDeviceTree, dt, args.outfile)
+        dt = get_adt(args.infile)
+        args.outfile.write(to_fdt(dt))
     conv_fdt_parser = subparsers.add_parser('to-fdt', help='convert to flattened device tree')
     conv_fdt_parser.add_argument('infile', type=argparse.FileType('rb'), help='input file')
     conv_fdt_parser.add_argument('outfile', type=argparse.FileType('w+b'), nargs='?', default=sys.stdout.buffer, help='output file')
@@ -518,21 +1595,31 @@ if __name__ == '__main__':
 
     def do_conv_adt(args):
         dt = get_adt(args.infile)
-        restruct.emit(AppleDeviceTree, dt, args.outfile)
+        if args.restruct:
+            restruct.emit(AppleDeviceTree, dt, args.outfile)
+        else:
+            args.outfile.write(to_adt(dt))
     conv_adt_parser = subparsers.add_parser('to-adt', help='convert to Apple device tree')
     conv_adt_parser.add_argument('infile', type=argparse.FileType('rb'), help='input file')
     conv_adt_parser.add_argument('outfile', type=argparse.FileType('w+b'), nargs='?', default=sys.stdout.buffer, help='output file')
     conv_adt_parser.set_defaults(func=do_conv_adt)
 
     def do_conv_src(args):
-        dt = get_adt(args.infile)
-        dts = to_dts(dt)
-        args.outfile.write(dts)
+        write_chunks(iter_dts(get_events(args.infile)), args.outfile)
     conv_src_parser = subparsers.add_parser('to-src', help='convert to device tree source')
     conv_src_parser.add_argument('infile', type=argparse.FileType('rb'), help='input file')
     conv_src_parser.add_argument('outfile', type=argparse.FileType('w'), nargs='?', default=sys.stdout, help='output file')
     conv_src_parser.set_defaults(func=do_conv_src)
 
+    def do_conv_from_src(args):
+        dt = parse_dts(args.infile.read(), order='big' if args.fdt else 'little')
+        args.outfile.write(to_fdt(dt) if args.fdt else to_adt(dt))
+    conv_from_src_parser = subparsers.add_parser('from-src', help='compile device tree source')
+    conv_from_src_parser.add_argument('-f', '--fdt', action='store_true', help='output a flattened device tree instead of an Apple device tree')
+    conv_from_src_parser.add_argument('infile', type=argparse.FileType('r'), help='input file')
+    conv_from_src_parser.add_argument('outfile', type=argparse.FileType('w+b'), nargs='?', default=sys.stdout.buffer, help='output file')
+    conv_from_src_parser.set_defaults(func=do_conv_from_src)
+
     args = parser.parse_args()
     if not args.func:
         parser.error('a subcommand must be provided')
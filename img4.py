@@ -6,14 +6,17 @@
 # - https://lapo.it/asn1js/
 # - hexdump tool of choice
 
+import collections
 import functools
+import itertools
+import mmap
+import os
+import struct
 from asn1crypto.core import (
     Enumerated, Choice, Sequence, SequenceOf, SetOf,
     Integer, IA5String, OctetString, ParsableOctetString, Integer,
     Any
 )
-from asn1crypto.x509 import Certificate
-import restruct
 
 
 def ascii2int(s):
@@ -103,8 +106,24 @@ class IMG4ManifestContent(Choice):
 class IMG4ManifestContentSet(SetOf):
     _child_spec = IMG4ManifestContent
 
+class LazyCertificate:
+    """ resolves to asn1crypto.x509.Certificate on first use, so only manifest users pay for importing it """
+    def __get__(self, instance, owner):
+        from asn1crypto.x509 import Certificate
+        return Certificate
+
+def __getattr__(name):
+    # names this module used to import eagerly, still available as attributes
+    if name == 'Certificate':
+        from asn1crypto.x509 import Certificate
+        return Certificate
+    if name == 'restruct':
+        import restruct
+        return restruct
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
 class IMG4CertificateSequence(SequenceOf):
-    _child_spec = Certificate
+    _child_spec = LazyCertificate()
 
 class IMG4Manifest(Sequence):
     _fields = [
@@ -124,85 +143,1365 @@ class IMG4(Sequence):
     ]
 
 
+
+CHUNK_SIZE = 16 * 1024 * 1024
+
+def _map_file(f):
+    """ map a file object read-only """
+    if not os.fstat(f.fileno()).st_size:
+        # mmap refuses empty files with a rather unhelpful message
+        raise ValueError('{} is empty'.format(getattr(f, 'name', 'file')))
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _der_header(buf, offset=0):
+    """ parse DER identifier and length octets at offset: returns (class, constructed, tag, header size, content size) """
+    try:
+        return _der_header_octets(buf, offset)
+    except IndexError:
+        raise ValueError('truncated DER element at offset {}'.format(offset))
+
+def _der_header_octets(buf, offset):
+    b = buf[offset]
+    cls = b >> 6
+    constructed = bool(b & 0x20)
+    tag = b & 0x1F
+    pos = offset + 1
+    if tag == 0x1F:
+        tag = 0
+        while True:
+            b = buf[pos]
+            pos += 1
+            tag = (tag << 7) | (b & 0x7F)
+            if not b & 0x80:
+                break
+    b = buf[pos]
+    pos += 1
+    if b & 0x80:
+        n = b & 0x7F
+        if not n:
+            raise ValueError('indefinite length at offset {}'.format(offset))
+        if n > 8:
+            raise ValueError('oversized length at offset {}'.format(offset))
+        if pos + n > len(buf):
+            raise IndexError(pos + n)
+        length = int.from_bytes(buf[pos:pos + n], byteorder='big')
+        pos += n
+    else:
+        length = b
+    return cls, constructed, tag, pos - offset, length
+
+def _der_span(buf, offset):
+    """ like _der_header(), but also checks that the contents fit in buf """
+    header = _der_header(buf, offset)
+    if offset + header[3] + header[4] > len(buf):
+        raise ValueError('truncated DER element at offset {}'.format(offset))
+    return header
+
+def _der_children(buf, offset, end):
+    while offset < end:
+        header = _der_span(buf, offset)
+        yield offset, header
+        offset += header[3] + header[4]
+
+DER_CLASSES = ('universal', 'application', 'context', 'private')
+
+def iter_der(buf, offset=0, end=None, max_depth=None, strict=True):
+    """
+    walk the DER values in buf[offset:end] depth-first without decoding their contents,
+    yielding (depth, offset, class, tag, header size, content size) for each.
+    Unless strict, values overrunning their container are clamped to it instead of raising.
+    """
+    if end is None:
+        end = len(buf)
+    ends = []
+    while offset < end:
+        while ends and offset >= ends[-1]:
+            ends.pop()
+        depth = len(ends)
+        cls, constructed, tag, hlen, length = _der_header(buf, offset)
+        value_end = offset + hlen + length
+        container_end = ends[-1] if ends else end
+        if value_end > container_end:
+            if strict:
+                raise ValueError('value at offset {} overruns its container'.format(offset))
+            value_end = container_end
+        yield depth, offset, cls, tag, hlen, length
+        if constructed and (max_depth is None or depth < max_depth):
+            ends.append(value_end)
+            offset += hlen
+        else:
+            offset = value_end
+
+CONTAINER_TYPES = {
+    b'IMG4': IMG4,
+    b'IM4M': IMG4Manifest,
+    b'IM4P': IMG4Payload,
+}
+
+def _container_magic(buf):
+    """ read the magic IA5String opening the outer sequence: returns (magic, outer header size, outer content size, magic end offset) """
+    # only the start of the file is needed to detect its type
+    cls, constructed, tag, hlen, length = _der_header(buf, 0)
+    if cls != 0 or not constructed or tag != Sequence.tag:
+        raise ValueError('not a DER sequence')
+    _, _, tag, mhlen, mlen = _der_span(buf, hlen)
+    if tag != IA5String.tag:
+        raise ValueError('no magic string')
+    start = hlen + mhlen
+    return bytes(buf[start:start + mlen]), hlen, length, start + mlen
+
+def detect(buf):
+    """ determine the container type of buf from its magic, without parsing it """
+    magic = _container_magic(buf)[0]
+    if magic not in CONTAINER_TYPES:
+        raise ValueError('unknown magic: {!r}'.format(magic))
+    return CONTAINER_TYPES[magic]
+
+def load(buf):
+    """ load buf as the container type its magic indicates """
+    return detect(buf).load(bytes(buf))
+
+def payload_offset(buf):
+    """ locate the IM4P sequence in buf (an IM4P or IMG4): returns (offset, header size, content size) """
+    magic, hlen, length, end = _container_magic(buf)
+    _der_span(buf, 0)
+    if magic == b'IMG4':
+        _, _, _, hlen, length = _der_span(buf, end)
+        return end, hlen, length
+    if magic == b'IM4P':
+        return 0, hlen, length
+    raise ValueError('not an IM4P or IMG4 file: {!r}'.format(magic))
+
+def payload_spans(buf):
+    """ locate the IM4P fields in buf (an IM4P or IMG4) without decoding them: returns {field: (offset, header size, content size)} """
+    start, hlen, length = payload_offset(buf)
+    spans = {}
+    fields = iter(IMG4Payload._fields)
+    for offset, (_, _, tag, fhlen, flen) in _der_children(buf, start + hlen, start + hlen + length):
+        for name, spec, *_ in fields:
+            if spec.tag == tag:
+                spans[name] = (offset, fhlen, flen)
+                break
+        else:
+            break
+    return spans
+
+def _iter_span(buf, start, end, chunk_size=CHUNK_SIZE):
+    """
+    yield buf[start:end] as memoryview chunks, dropping mmap pages once they have been consumed.
+    Each chunk is released when the next one is requested or the generator is closed.
+    """
+    view = memoryview(buf)
+    try:
+        page_start = start - start % mmap.PAGESIZE
+        for offset in range(start, end, chunk_size):
+            with view[offset:min(offset + chunk_size, end)] as chunk:
+                yield chunk
+            if hasattr(buf, 'madvise') and hasattr(mmap, 'MADV_DONTNEED'):
+                # drop pages we are done with to keep RSS flat
+                page_end = min(offset + chunk_size, end)
+                page_end -= page_end % mmap.PAGESIZE
+                if page_end > page_start:
+                    buf.madvise(mmap.MADV_DONTNEED, page_start, page_end - page_start)
+                    page_start = page_end
+    finally:
+        view.release()
+
+
+LZFSE_END_MAGIC = b'bvx$'
+LZFSE_RAW_MAGIC = b'bvx-'
+# larger than the maximum match distance of both LZFSE (262139) and LZVN (65535)
+LZFSE_WINDOW_SIZE = 1 << 18
+# amount of output to decode per call, large enough to amortize re-decoding the window
+LZFSE_BATCH_SIZE = 1 << 20
+
+LZFSE_HEADER_SIZES = {
+    LZFSE_END_MAGIC: 4,
+    LZFSE_RAW_MAGIC: 8,
+    b'bvxn': 12,
+    b'bvx1': 28,
+    b'bvx2': 32,
+}
+
+def _lzfse_block_size(header):
+    """ size of the LZFSE block starting with header, or None if more header bytes are needed """
+    magic = bytes(header[:4])
+    if magic not in LZFSE_HEADER_SIZES:
+        raise ValueError('invalid LZFSE block magic: {!r}'.format(magic))
+    if len(header) < LZFSE_HEADER_SIZES[magic]:
+        return None
+
+    if magic == LZFSE_END_MAGIC:
+        return 4
+    if magic == LZFSE_RAW_MAGIC:
+        return 8 + struct.unpack_from('<I', header, 4)[0]
+    if magic == b'bvxn':
+        return 12 + struct.unpack_from('<I', header, 8)[0]
+    if magic == b'bvx1':
+        # unpacked v1 header: 7 u32 counts, state words and frequency tables, 770 bytes in total
+        n_literal_payload_bytes, n_lmd_payload_bytes = struct.unpack_from('<II', header, 20)
+        return 770 + n_literal_payload_bytes + n_lmd_payload_bytes
+    # packed v2 header: n_literal_payload_bytes in field 0, n_lmd_payload_bytes in field 1, header_size in field 2
+    v0, v1, v2 = struct.unpack_from('<QQQ', header, 8)
+    return (v2 & 0xFFFFFFFF) + ((v0 >> 20) & 0xFFFFF) + ((v1 >> 40) & 0xFFFFF)
+
+def iter_lzfse_blocks(chunks):
+    """ split an LZFSE stream, given as an iterable of chunks, into (magic, raw size, block) tuples """
+    pending = bytearray()
+    chunks = iter(chunks)
+    while True:
+        size = _lzfse_block_size(pending) if len(pending) >= 4 else None
+        while size is None or len(pending) < size:
+            chunk = next(chunks, None)
+            if chunk is None:
+                if not pending:
+                    return
+                raise ValueError('truncated LZFSE stream')
+            pending += chunk
+            # don't keep a view of the input alive while suspended
+            del chunk
+            if size is None and len(pending) >= 4:
+                size = _lzfse_block_size(pending)
+
+        magic = bytes(pending[:4])
+        if magic == LZFSE_END_MAGIC:
+            return
+        block = bytes(pending[:size])
+        del pending[:size]
+        yield magic, struct.unpack_from('<I', block, 4)[0], block
+
+def iter_decompress_lzfse(chunks, size=None, window_size=LZFSE_WINDOW_SIZE, batch_size=LZFSE_BATCH_SIZE):
+    """
+    decompress an LZFSE stream block by block, yielding output as it becomes available.
+
+    Blocks may refer back to earlier output, so each batch of blocks is decoded behind an
+    uncompressed block holding the last window_size bytes of output.
+    """
+    import lzfse
+
+    window = b''
+    total = 0
+    batch = []
+    batch_raw_size = 0
+
+    def flush():
+        if not batch_raw_size:
+            return b''
+        prefix = LZFSE_RAW_MAGIC + struct.pack('<I', len(window)) + window if window else b''
+        data = lzfse.decompress(b''.join([prefix] + batch + [LZFSE_END_MAGIC]))
+        if len(data) != len(window) + batch_raw_size:
+            raise ValueError('LZFSE blocks decompressed to {} bytes instead of {}'.format(len(data) - len(window), batch_raw_size))
+        return data[len(window):]
+
+    for magic, raw_size, block in iter_lzfse_blocks(chunks):
+        batch.append(block)
+        batch_raw_size += raw_size
+        if batch_raw_size < batch_size:
+            continue
+
+        data = flush()
+        total += len(data)
+        if size is not None and total > size:
+            raise ValueError('decompressed data exceeds original size of {} bytes'.format(size))
+        yield data
+        window = (window + data[-window_size:])[-window_size:]
+        batch = []
+        batch_raw_size = 0
+
+    if batch:
+        data = flush()
+        total += len(data)
+        if data:
+            yield data
+    if size is not None and total != size:
+        raise ValueError('decompressed data is {} bytes instead of original size of {} bytes'.format(total, size))
+
+LZSS_MAGIC = b'complzss'
+LZSS_HEADER = struct.Struct('>8sIII')
+LZSS_HEADER_SIZE = 0x180
+LZSS_RING_SIZE = 4096
+LZSS_MAX_MATCH = 18
+
+def _lzss_decode(src, size):
+    """ decode an Okumura-style LZSS stream into a preallocated buffer of the declared output size """
+    out = bytearray(size)
+    n = len(src)
+    s = p = 0
+    while s < n and p < size:
+        flags = src[s]
+        s += 1
+        if flags == 0xFF and s + 8 <= n and p + 8 <= size:
+            # eight literals in a row
+            out[p:p + 8] = src[s:s + 8]
+            s += 8
+            p += 8
+            continue
+        for _ in range(8):
+            if p >= size:
+                break
+            if flags & 1:
+                if s >= n:
+                    break
+                out[p] = src[s]
+                p += 1
+                s += 1
+            else:
+                if s + 1 >= n:
+                    s = n
+                    break
+                i = src[s] | ((src[s + 1] & 0xF0) << 4)
+                length = min((src[s + 1] & 0x0F) + 3, size - p)
+                s += 2
+                # the ring buffer starts writing at N - F, so ring offset i is this far behind p
+                distance = ((p + LZSS_RING_SIZE - LZSS_MAX_MATCH - i) & (LZSS_RING_SIZE - 1)) or LZSS_RING_SIZE
+                q = p - distance
+                if q < 0:
+                    # reference into the initial ring buffer contents
+                    for k in range(length):
+                        out[p + k] = out[q + k] if q + k >= 0 else 0x20
+                elif distance >= length:
+                    out[p:p + length] = out[q:q + length]
+                else:
+                    out[p:p + length] = (out[q:p] * (length // distance + 1))[:length]
+                p += length
+            flags >>= 1
+    if p != size:
+        raise ValueError('LZSS data decompressed to {} bytes instead of {}'.format(p, size))
+    return out
+
+def iter_decompress_lzss(chunks, size=None):
+    """ decompress a complzss container (as used by older kernelcaches) """
+    import zlib
+
+    # chunks may be views that are only valid until the next one is requested
+    data = bytearray()
+    for chunk in chunks:
+        data += chunk
+    magic, adler32, uncompressed_size, compressed_size = LZSS_HEADER.unpack_from(data)
+    if magic != LZSS_MAGIC:
+        raise ValueError('invalid LZSS magic: {!r}'.format(magic))
+    if size is not None and size != uncompressed_size:
+        raise ValueError('LZSS size of {} bytes does not match original size of {} bytes'.format(uncompressed_size, size))
+    out = _lzss_decode(memoryview(data)[LZSS_HEADER_SIZE:LZSS_HEADER_SIZE + compressed_size], uncompressed_size)
+    if zlib.adler32(out) != adler32:
+        raise ValueError('LZSS checksum mismatch')
+    yield out
+
+DECOMPRESSORS = {
+    'lzfse': iter_decompress_lzfse,
+    'lzss':  iter_decompress_lzss,
+}
+
+# magics at the start of payload data without compression metadata
+DECOMPRESSOR_MAGICS = {
+    LZSS_MAGIC:      'lzss',
+    b'bvx2':         'lzfse',
+    b'bvx1':         'lzfse',
+    b'bvxn':         'lzfse',
+    LZFSE_RAW_MAGIC: 'lzfse',
+}
+
+def find_decompressor(algorithm=None, data=b''):
+    """ find decompressor for a compression algorithm id or name, or sniffed from the start of the data """
+    if algorithm is None:
+        for magic, name in DECOMPRESSOR_MAGICS.items():
+            if bytes(data[:len(magic)]) == magic:
+                algorithm = name
+                break
+        else:
+            return None
+    if isinstance(algorithm, int):
+        algorithm = IMG4CompressionAlgorithm._map.get(algorithm, algorithm)
+    if algorithm not in DECOMPRESSORS:
+        raise ValueError('unknown algorithm: {}'.format(algorithm))
+    return algorithm
+
+AES_BLOCK_SIZE = 16
+
+def iter_decrypt(chunks, iv, key, size):
+    """ AES-CBC decrypt size bytes of chunks as they come in; a trailing partial block is passed through as-is """
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+    aligned = size - size % AES_BLOCK_SIZE
+    offset = 0
+    tail = []
+    for chunk in chunks:
+        n = max(0, min(len(chunk), aligned - offset))
+        data = decryptor.update(chunk[:n]) if n else b''
+        if n < len(chunk):
+            tail.append(bytes(chunk[n:]))
+        offset += len(chunk)
+        # don't keep a view of the input alive while suspended
+        del chunk
+        if data:
+            yield data
+    decryptor.finalize()
+    if tail:
+        yield b''.join(tail)
+
+def payload_keybags(buf):
+    """ return the keybags of the payload in buf as a list of {'id', 'iv', 'key'} """
+    spans = payload_spans(buf)
+    if 'keybags' not in spans:
+        return []
+    offset, hlen, length = spans['keybags']
+    return IMG4KeyBagSequence.load(bytes(buf[offset + hlen:offset + hlen + length])).native
+
+def extract_payload(buf, outfile, iv=None, key=None):
+    """
+    write the (decrypted and decompressed) payload data in buf to outfile, streaming it straight out of buf.
+    Returns (algorithm, data size, output size).
+    """
+    spans = payload_spans(buf)
+    if 'data' not in spans:
+        raise ValueError('payload has no data')
+    offset, hlen, length = spans['data']
+    start = offset + hlen
+    span = chunks = _iter_span(buf, start, start + length)
+    try:
+        if key:
+            chunks = iter_decrypt(chunks, iv, key, length)
+
+        if 'compression' in spans:
+            coffset, chlen, clen = spans['compression']
+            compression = IMG4Compression.load(bytes(buf[coffset:coffset + chlen + clen])).native
+            algorithm = find_decompressor(compression['algorithm'])
+            size = compression['original_size']
+        else:
+            # sniff the magic from the first (decrypted) chunk
+            first = next(chunks, b'')
+            chunks = itertools.chain([first], chunks)
+            algorithm = find_decompressor(data=first[:8])
+            size = None
+        if algorithm:
+            chunks = DECOMPRESSORS[algorithm](chunks, size=size)
+
+        written = 0
+        for chunk in chunks:
+            outfile.write(chunk)
+            written += len(chunk)
+    finally:
+        # release the current chunk of buf now: generators kept alive by a traceback would otherwise
+        # keep it exported, and closing an mmap buf would then mask the original error
+        span.close()
+    return algorithm, length, written
+
+
+def _der_encode_header(cls, constructed, tag, length):
+    """ encode DER identifier and length octets """
+    first = (cls << 6) | (0x20 if constructed else 0)
+    if tag < 0x1F:
+        ident = bytes([first | tag])
+    else:
+        tag_bytes = [tag & 0x7F]
+        tag >>= 7
+        while tag:
+            tag_bytes.insert(0, 0x80 | (tag & 0x7F))
+            tag >>= 7
+        ident = bytes([first | 0x1F] + tag_bytes)
+    if length < 0x80:
+        return ident + bytes([length])
+    length_bytes = length.to_bytes((length.bit_length() + 7) // 8, byteorder='big')
+    return ident + bytes([0x80 | len(length_bytes)]) + length_bytes
+
+def _source_size(source):
+    if hasattr(source, 'fileno'):
+        return os.fstat(source.fileno()).st_size
+    return len(source)
+
+def _copy_source(outfile, source, size):
+    """ copy all of source (a file object or bytes-like) to outfile, in-kernel where possible """
+    if not hasattr(source, 'fileno'):
+        outfile.write(source)
+        return
+
+    outfile.flush()
+    offset = 0
+    for name in ('copy_file_range', 'sendfile'):
+        copy = getattr(os, name, None)
+        if not copy:
+            continue
+        try:
+            while offset < size:
+                if name == 'sendfile':
+                    n = copy(outfile.fileno(), source.fileno(), offset, size - offset)
+                else:
+                    n = copy(source.fileno(), outfile.fileno(), size - offset, offset)
+                if not n:
+                    # copied less than expected: let the loop below finish or report it
+                    break
+                offset += n
+        except OSError:
+            # unsupported for this pair of files, try the next method from where we left off
+            continue
+        break
+
+    source.seek(offset)
+    while offset < size:
+        chunk = source.read(min(CHUNK_SIZE, size - offset))
+        if not chunk:
+            raise ValueError('source file shrunk while copying')
+        outfile.write(chunk)
+        offset += len(chunk)
+
+def _write_container(outfile, head, source, size, tail, manifest=None):
+    """ write head + source + tail, wrapped in an IMG4 together with manifest if given """
+    if manifest is not None:
+        magic = IA5String('IMG4').dump()
+        manifest_head = _der_encode_header(2, True, 0, len(manifest))
+        length = len(magic) + len(head) + size + len(tail) + len(manifest_head) + len(manifest)
+        head = _der_encode_header(0, True, Sequence.tag, length) + magic + head
+        tail = tail + manifest_head + bytes(manifest)
+    outfile.write(head)
+    _copy_source(outfile, source, size)
+    outfile.write(tail)
+
+def build_payload(outfile, type, description, data, compression=None, keybags=None, manifest=None):
+    """
+    write an IM4P around data (a file object or bytes-like) without re-encoding it,
+    or an IMG4 if the encoded manifest is given as well.
+    """
+    size = _source_size(data)
+    head = b''.join([
+        IA5String('IM4P').dump(), IA5String(type).dump(), IA5String(description).dump(),
+        _der_encode_header(0, False, OctetString.tag, size),
+    ])
+    tail = b''
+    if keybags:
+        tail += OctetString(IMG4KeyBagSequence(keybags).dump()).dump()
+    if compression:
+        tail += IMG4Compression(compression).dump()
+    head = _der_encode_header(0, True, Sequence.tag, len(head) + size + len(tail)) + head
+    _write_container(outfile, head, data, size, tail, manifest=manifest)
+
+def build_img4(outfile, payload, manifest):
+    """ write an IMG4 from an encoded IM4P (a file object or bytes-like) and IM4M """
+    if detect(manifest) is not IMG4Manifest:
+        raise ValueError('manifest is not an IM4M')
+    _write_container(outfile, b'', payload, _source_size(payload), b'', manifest=manifest)
+
+def decompress(data, algorithm=None, size=None):
+    """ decompress data with an algorithm name or id, or the one sniffed from its magic; returns data as-is if uncompressed """
+    algorithm = find_decompressor(algorithm, data)
+    if not algorithm:
+        return bytes(data)
+    return b''.join(DECOMPRESSORS[algorithm](_iter_span(data, 0, len(data)), size=size))
+
+def _der_string(buf, offset):
+    _, _, _, hlen, length = _der_span(buf, offset)
+    return bytes(buf[offset + hlen:offset + hlen + length]).decode('ascii')
+
+def manifest_offset(buf):
+    """ locate the IM4M sequence in buf (an IM4M or IMG4) """
+    magic, hlen, length, end = _container_magic(buf)
+    _der_span(buf, 0)
+    if magic == b'IM4M':
+        return 0
+    if magic != b'IMG4':
+        raise ValueError('not an IM4M or IMG4 file: {!r}'.format(magic))
+    for offset, (cls, _, tag, fhlen, _) in _der_children(buf, end, hlen + length):
+        if cls == 2 and tag == 0:
+            return offset + fhlen
+    raise ValueError('IMG4 file has no manifest')
+
+class IMG4ManifestView:
+    """
+    lazy IM4M accessor: indexes property spans in one pass, and decodes values and certificates on access only.
+    It holds a view of buf until released, so use it as a context manager when buf is an mmap.
+    """
+
+    def __init__(self, buf):
+        self.buf = memoryview(buf)
+        self.spans = {}
+        self.index = {}
+        self._values = {}
+        self._certificates = None
+
+        try:
+            start = manifest_offset(self.buf)
+            _, _, _, hlen, length = _der_span(self.buf, start)
+            names = (name for name, *_ in IMG4Manifest._fields)
+            for name, (offset, header) in zip(names, _der_children(self.buf, start + hlen, start + hlen + length)):
+                self.spans[name] = (offset, header[3], header[4])
+
+            offset, hlen, length = self.spans['contents']
+            for body_offset, (_, _, _, bhlen, _) in _der_children(self.buf, offset + hlen, offset + hlen + length):
+                self._index_body(body_offset + bhlen)
+        except BaseException:
+            self.release()
+            raise
+
+    def release(self):
+        """ release the view of the underlying buffer; raw spans can no longer be accessed afterwards """
+        self.buf.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def _children(self, offset):
+        _, _, _, hlen, length = _der_span(self.buf, offset)
+        return _der_children(self.buf, offset + hlen, offset + hlen + length)
+
+    def _index_body(self, offset):
+        # MANB: SEQUENCE { IA5String type, SET { [PRIVATE tag] SEQUENCE { IA5String tag, SET { [PRIVATE key] ... } } } }
+        (_, _), (categories_offset, _) = self._children(offset)
+        for coffset, (_, _, _, chlen, _) in self._children(categories_offset):
+            (name_offset, _), (values_offset, _) = self._children(coffset + chlen)
+            values = self.index.setdefault(_der_string(self.buf, name_offset), {})
+            for voffset, (_, _, _, vhlen, _) in self._children(values_offset):
+                # [PRIVATE key] SEQUENCE { IA5String key, ANY value OPTIONAL }
+                inner = list(self._children(voffset + vhlen))
+                key = _der_string(self.buf, inner[0][0])
+                if len(inner) > 1:
+                    value_offset, header = inner[1]
+                    values[key] = (value_offset, value_offset + header[3] + header[4])
+                else:
+                    values[key] = None
+
+    def _field(self, name):
+        offset, hlen, length = self.spans[name]
+        return self.buf[offset:offset + hlen + length]
+
+    @property
+    def version(self):
+        return Integer.load(bytes(self._field('version'))).native
+
+    @property
+    def contents(self):
+        """ DER encoding of the signed contents """
+        return self._field('contents')
+
+    @property
+    def signature(self):
+        offset, hlen, length = self.spans['signature']
+        return bytes(self.buf[offset + hlen:offset + hlen + length])
+
+    @property
+    def certificates(self):
+        if self._certificates is None:
+            self._certificates = IMG4CertificateSequence.load(bytes(self._field('certificates')))
+        return self._certificates
+
+    @property
+    def raw_certificates(self):
+        """ DER encodings of the certificates, without parsing them """
+        offset, _, _ = self.spans['certificates']
+        return [bytes(self.buf[o:o + h[3] + h[4]]) for o, h in self._children(offset)]
+
+    def categories(self):
+        return list(self.index)
+
+    def keys(self, category):
+        return list(self.index[category])
+
+    def raw(self, category, key):
+        """ DER encoding of a property value, or None if it has no value """
+        span = self.index[category][key]
+        if span is None:
+            return None
+        return self.buf[span[0]:span[1]]
+
+    def get(self, category, key, default=None):
+        if key not in self.index.get(category, {}):
+            return default
+        if (category, key) not in self._values:
+            span = self.index[category][key]
+            # copy before decoding, so a decoding error doesn't leave a view of buf behind in the traceback
+            self._values[category, key] = Any.load(bytes(self.buf[span[0]:span[1]])).native if span is not None else None
+        return self._values[category, key]
+
+    def items(self, category=None):
+        """ yield (category, key, value) for one or all categories """
+        for c in ([category] if category is not None else self.index):
+            for k in self.index[c]:
+                yield c, k, self.get(c, k)
+
+    def __contains__(self, category):
+        return category in self.index
+
+def iter_manifest_properties(buf):
+    """ yield (category, key, value) for all properties of the manifest in buf (an IM4M or IMG4) """
+    with IMG4ManifestView(buf) as manifest:
+        yield from manifest.items()
+
+
+def describe(buf):
+    """ summarize the container in buf without decoding its payload data or certificates """
+    magic = _container_magic(buf)[0]
+    info = {'container': magic.decode('ascii')}
+    if magic in (b'IMG4', b'IM4P'):
+        spans = payload_spans(buf)
+        info['type'] = _der_string(buf, spans['type'][0])
+        info['description'] = _der_string(buf, spans['description'][0])
+        info['keybags'] = 'keybags' in spans
+        if 'compression' in spans:
+            offset, hlen, length = spans['compression']
+            info['compression'] = dict(IMG4Compression.load(bytes(buf[offset:offset + hlen + length])).native)
+        else:
+            info['compression'] = None
+    if magic in (b'IMG4', b'IM4M'):
+        info['manifest'] = {}
+        with IMG4ManifestView(buf) as manifest:
+            for category, key, value in manifest.items():
+                info['manifest'].setdefault(category, {})[key] = value
+    return info
+
+BATCH_EXTENSIONS = ('.img4', '.im4p', '.im4m')
+
+def iter_batch_paths(source):
+    """ yield (path, relative name) for files in a directory tree, or listed one per line in a file """
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(BATCH_EXTENSIONS):
+                    path = os.path.join(root, name)
+                    yield path, os.path.relpath(path, source)
+    else:
+        with open(source) as f:
+            for line in f:
+                path = line.strip()
+                if path:
+                    yield path, os.path.basename(path)
+
+def _batch_worker(path, outpath=None):
+    info = {'path': path}
+    created = False
+    try:
+        with open(path, 'rb') as f, _map_file(f) as m:
+            info.update(describe(m))
+            if outpath and info.get('type') is not None:
+                os.makedirs(os.path.dirname(outpath) or '.', exist_ok=True)
+                with open(outpath, 'wb') as outfile:
+                    created = True
+                    extract_payload(m, outfile)
+                info['output'] = outpath
+    except Exception as e:
+        info['error'] = str(e)
+        if created:
+            # don't leave a partial payload behind
+            try:
+                os.unlink(outpath)
+            except OSError:
+                pass
+    return info
+
+def iter_batch(source, outdir=None, jobs=None, backlog=None):
+    """ describe (and optionally extract) all files in source over a process pool, yielding results as they finish """
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    jobs = jobs or os.cpu_count() or 1
+    backlog = backlog or jobs * 4
+    outputs = {}
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        pending = set()
+        for path, name in iter_batch_paths(source):
+            if len(pending) >= backlog:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            outpath = None
+            if outdir:
+                # keep the extension so foo.img4 and foo.im4p don't collide
+                outpath = os.path.join(outdir, name + '.bin')
+                key = os.path.normcase(os.path.normpath(outpath))
+                if key in outputs:
+                    yield {'path': path, 'error': 'output file {} is already used for {}'.format(outpath, outputs[key])}
+                    continue
+                outputs[key] = path
+            pending.add(pool.submit(_batch_worker, path, outpath))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+DIGEST_ALGORITHMS = {
+    20: 'sha1',
+    32: 'sha256',
+    48: 'sha384',
+    64: 'sha512',
+}
+
+def hash_payload(path, algorithms):
+    """ hash the DER-encoded IM4P in file path with the given hashlib algorithms in one pass: returns (type, {algorithm: digest}) """
+    import hashlib
+
+    with open(path, 'rb') as f, _map_file(f) as m:
+        offset, hlen, length = payload_offset(m)
+        type = _der_string(m, payload_spans(m)['type'][0])
+        hashes = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+        for chunk in _iter_span(m, offset, offset + hlen + length):
+            with chunk:
+                for h in hashes.values():
+                    # large updates release the GIL
+                    h.update(chunk)
+    return type, {algorithm: h.digest() for algorithm, h in hashes.items()}
+
+def iter_verify_paths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for p, _ in iter_batch_paths(path):
+                if not p.lower().endswith('.im4m'):
+                    yield p
+        else:
+            yield path
+
+def verify_payloads(manifest, paths, jobs=None):
+    """
+    check payload files against the DGST properties of manifest (an IMG4ManifestView), hashing them in a thread pool.
+    Yields {'path', 'type', 'status', ...} with status one of 'match', 'mismatch', 'unknown' or 'error'.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    digests = {c: manifest.get(c, 'DGST') for c in manifest.categories() if 'DGST' in manifest.index[c]}
+    algorithms = set()
+    for digest in digests.values():
+        if len(digest) not in DIGEST_ALGORITHMS:
+            raise ValueError('unknown digest length: {}'.format(len(digest)))
+        algorithms.add(DIGEST_ALGORITHMS[len(digest)])
+
+    def check(path):
+        result = {'path': path}
+        try:
+            type, hashes = hash_payload(path, algorithms)
+        except Exception as e:
+            result.update(status='error', error=str(e))
+            return result
+        result['type'] = type
+        if type not in digests:
+            result['status'] = 'unknown'
+        else:
+            expected = digests[type]
+            actual = hashes[DIGEST_ALGORITHMS[len(expected)]]
+            result.update(status='match' if actual == expected else 'mismatch', expected=expected, digest=actual)
+        return result
+
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        yield from pool.map(check, iter_verify_paths(paths))
+
+SIGNATURE_HASH_ALGORITHMS = ('sha1', 'sha256', 'sha384', 'sha512')
+
+def _verify_signature(public_key, signature, data, hash_names):
+    """ check an RSA (PKCS#1 v1.5) or ECDSA signature, trying each of the hash algorithms """
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+
+    for name in hash_names:
+        algorithm = getattr(hashes, name.upper())()
+        try:
+            if isinstance(public_key, rsa.RSAPublicKey):
+                public_key.verify(signature, data, padding.PKCS1v15(), algorithm)
+            elif isinstance(public_key, ec.EllipticCurvePublicKey):
+                public_key.verify(signature, data, ec.ECDSA(algorithm))
+            else:
+                raise ValueError('unsupported key type: {}'.format(type(public_key).__name__))
+            return name
+        except InvalidSignature:
+            continue
+    raise ValueError('invalid signature')
+
+class ManifestSignatureVerifier:
+    """
+    verifies IM4M signatures and their certificate chains, keeping LRU caches of parsed certificates and of
+    verified certificate signatures keyed by issuer and subject fingerprints, so intermediates and roots
+    shared between otherwise different chains are only parsed and checked once.
+    """
+
+    def __init__(self, roots=(), cache_size=256):
+        from cryptography import x509
+        self.roots = [
+            x509.load_pem_x509_certificate(r) if r.startswith(b'-----BEGIN') else x509.load_der_x509_certificate(r)
+            for r in map(bytes, roots)
+        ]
+        self.cache = collections.OrderedDict()
+        self.certificates = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self, der):
+        """ parse a DER certificate, or look it up """
+        from cryptography import x509
+
+        cert = self.certificates.get(der)
+        if cert is not None:
+            self.certificates.move_to_end(der)
+            return cert
+        cert = x509.load_der_x509_certificate(der)
+        self.certificates[der] = cert
+        if len(self.certificates) > self.cache_size:
+            self.certificates.popitem(last=False)
+        return cert
+
+    @staticmethod
+    def _check_issuer(issuer):
+        """ make sure issuer may sign certificates """
+        from cryptography import x509
+
+        try:
+            ca = issuer.extensions.get_extension_for_class(x509.BasicConstraints).value.ca
+        except x509.ExtensionNotFound:
+            ca = False
+        if not ca:
+            raise ValueError('issuer {} is not a CA'.format(issuer.subject.rfc4514_string()))
+        try:
+            usage = issuer.extensions.get_extension_for_class(x509.KeyUsage).value
+        except x509.ExtensionNotFound:
+            return
+        if not usage.key_cert_sign:
+            raise ValueError('issuer {} may not sign certificates'.format(issuer.subject.rfc4514_string()))
+
+    def _check(self, cert, issuer):
+        """ verify that issuer is a CA and signed cert, or look it up """
+        from cryptography.hazmat.primitives import hashes
+
+        key = (issuer.fingerprint(hashes.SHA256()), cert.fingerprint(hashes.SHA256()))
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return
+        self.misses += 1
+        self._check_issuer(issuer)
+        _verify_signature(issuer.public_key(), cert.signature, cert.tbs_certificate_bytes, [cert.signature_hash_algorithm.name])
+        self.cache[key] = True
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def verify_chain(self, ders):
+        """ verify the certificate chain given as DER encodings: returns (leaf certificate, anchored to a root) """
+        certs = [self._load(bytes(der)) for der in ders]
+        issuers = {c.issuer for c in certs if c.issuer != c.subject}
+        leaves = [c for c in certs if c.subject not in issuers]
+        if len(leaves) != 1:
+            raise ValueError('could not determine leaf certificate')
+        by_subject = {c.subject: c for c in certs}
+
+        cert = leaves[0]
+        chain = [cert]
+        while cert.issuer != cert.subject and cert.issuer in by_subject:
+            issuer = by_subject[cert.issuer]
+            if issuer in chain:
+                raise ValueError('certificate chain contains a loop')
+            self._check(cert, issuer)
+            chain.append(issuer)
+            cert = issuer
+        if cert.issuer == cert.subject:
+            self._check(cert, cert)
+
+        anchored = False
+        for root in self.roots:
+            if root == cert:
+                anchored = True
+            elif root.subject == cert.issuer:
+                self._check(cert, root)
+                anchored = True
+        return leaves[0], anchored
+
+    def verify(self, manifest):
+        """ verify an IMG4ManifestView's signature and certificate chain: returns whether the chain is anchored to a root """
+        leaf, anchored = self.verify_chain(manifest.raw_certificates)
+        hash_names = [leaf.signature_hash_algorithm.name]
+        hash_names += [n for n in SIGNATURE_HASH_ALGORITHMS if n not in hash_names]
+        _verify_signature(leaf.public_key(), manifest.signature, bytes(manifest.contents), hash_names)
+        return anchored
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id    INTEGER PRIMARY KEY,
+    path  TEXT UNIQUE NOT NULL,
+    mtime INTEGER NOT NULL,
+    size  INTEGER NOT NULL,
+    hash  BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS properties (
+    file_id  INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    category TEXT NOT NULL,
+    key      TEXT NOT NULL,
+    value
+);
+CREATE INDEX IF NOT EXISTS properties_by_category ON properties (category, key, value);
+CREATE INDEX IF NOT EXISTS properties_by_key ON properties (key, value);
+CREATE INDEX IF NOT EXISTS properties_by_file ON properties (file_id);
+"""
+
+def open_index(path):
+    """ open (and create if needed) a SQLite manifest property index """
+    import sqlite3
+    db = sqlite3.connect(path)
+    db.execute('PRAGMA foreign_keys = ON')
+    db.executescript(INDEX_SCHEMA)
+    return db
+
+def _index_value(v):
+    if isinstance(v, int) and not -(1 << 63) <= v < (1 << 63):
+        return str(v)
+    if v is None or isinstance(v, (int, str, bytes)):
+        return v
+    return str(v)
+
+def update_index(db, paths, prune=False):
+    """
+    (re)index the manifest properties of the given files and directories, skipping files whose
+    mtime, size or content hash did not change: returns (indexed, unchanged, failed, pruned) counts.
+    """
+    import hashlib
+
+    counts = collections.Counter()
+    with db:
+        for path in paths:
+            if os.path.isdir(path):
+                files = [p for p, _ in iter_batch_paths(path) if not p.lower().endswith('.im4p')]
+            else:
+                files = [path]
+            for p in files:
+                p = os.path.abspath(p)
+                try:
+                    st = os.stat(p)
+                    row = db.execute('SELECT id, mtime, size, hash FROM files WHERE path = ?', (p,)).fetchone()
+                    if row and row[1:3] == (st.st_mtime_ns, st.st_size):
+                        counts['unchanged'] += 1
+                        continue
+                    with open(p, 'rb') as f:
+                        contents = f.read()
+                    digest = hashlib.sha256(contents).digest()
+                    if row and row[3] == digest:
+                        db.execute('UPDATE files SET mtime = ? WHERE id = ?', (st.st_mtime_ns, row[0]))
+                        counts['unchanged'] += 1
+                        continue
+                    manifest = IMG4ManifestView(contents)
+                    values = [(category, key, _index_value(value)) for category, key, value in manifest.items()]
+                except Exception:
+                    counts['failed'] += 1
+                    continue
+
+                if row:
+                    db.execute('DELETE FROM properties WHERE file_id = ?', (row[0],))
+                    db.execute('UPDATE files SET mtime = ?, size = ?, hash = ? WHERE id = ?', (st.st_mtime_ns, st.st_size, digest, row[0]))
+                    file_id = row[0]
+                else:
+                    file_id = db.execute('INSERT INTO files (path, mtime, size, hash) VALUES (?, ?, ?, ?)', (p, st.st_mtime_ns, st.st_size, digest)).lastrowid
+                db.executemany('INSERT INTO properties (file_id, category, key, value) VALUES (?, ?, ?, ?)', [(file_id,) + v for v in values])
+                counts['indexed'] += 1
+
+        if prune:
+            for file_id, p in db.execute('SELECT id, path FROM files').fetchall():
+                if not os.path.exists(p):
+                    db.execute('DELETE FROM files WHERE id = ?', (file_id,))
+                    counts['pruned'] += 1
+    return counts['indexed'], counts['unchanged'], counts['failed'], counts['pruned']
+
+def _query_candidates(value):
+    """ possible stored values for a value given as text: integer, hex bytes, boolean or string """
+    candidates = [value]
+    try:
+        candidates.append(_index_value(int(value, 0)))
+    except ValueError:
+        pass
+    try:
+        candidates.append(bytes.fromhex(value))
+    except ValueError:
+        pass
+    if value.lower() in ('true', 'false'):
+        candidates.append(int(value.lower() == 'true'))
+    return candidates
+
+def query_index(db, conditions):
+    """ find paths of indexed manifests matching all conditions, given as '[CATEGORY.]KEY[=VALUE]' """
+    queries = []
+    params = []
+    for condition in conditions:
+        name, _, value = condition.partition('=')
+        category, _, key = name.rpartition('.')
+        clauses = []
+        if category:
+            clauses.append('category = ?')
+            params.append(category)
+        clauses.append('key = ?')
+        params.append(key)
+        if value:
+            candidates = _query_candidates(value)
+            clauses.append('value IN ({})'.format(', '.join('?' * len(candidates))))
+            params.extend(candidates)
+        queries.append('SELECT file_id FROM properties WHERE ' + ' AND '.join(clauses))
+    if not queries:
+        queries.append('SELECT id FROM files')
+    sql = 'SELECT path FROM files WHERE id IN ({}) ORDER BY path'.format(' INTERSECT '.join(queries))
+    return [path for path, in db.execute(sql, params)]
+
+def _json_value(v):
+    if isinstance(v, (bytes, bytearray)):
+        return v.hex()
+    return str(v)
+
+
 if __name__ == '__main__':
+    import sys
+    import time
     import argparse
+    import restruct
+
+    parser = argparse.ArgumentParser(description='process Image4 (.img4/.im4m/.im4p) files')
+    parser.set_defaults(func=None)
+    subparsers = parser.add_subparsers(help='subcommand')
+
+    def do_extract(args, buf, outfile):
+        iv = key = None
+        if args.key:
+            ivkey = bytes.fromhex(args.key)
+            iv, key = ivkey[:AES_BLOCK_SIZE], ivkey[AES_BLOCK_SIZE:]
+            if len(key) not in (16, 24, 32):
+                dump_parser.error('--key must be a 16-byte IV followed by a 16, 24 or 32-byte key')
+        elif args.keybag is not None:
+            keybags = {kb['id']: kb for kb in payload_keybags(buf)}
+            if args.keybag not in keybags:
+                dump_parser.error('no keybag with id {}'.format(args.keybag))
+            iv, key = keybags[args.keybag]['iv'], keybags[args.keybag]['key']
+
+        start = time.perf_counter()
+        algorithm, size, written = extract_payload(buf, outfile, iv=iv, key=key)
+        elapsed = time.perf_counter() - start
+        if algorithm:
+            print('decompressed {} -> {} bytes with {} in {:.3f}s ({:.1f} MB/s)'.format(
+                size, written, algorithm, elapsed, written / elapsed / 1e6 if elapsed else float('inf')
+            ), file=sys.stderr)
+
+    DER_TAG_NAMES = {
+        1: 'BOOLEAN', 2: 'INTEGER', 3: 'BIT STRING', 4: 'OCTET STRING', 5: 'NULL', 6: 'OBJECT IDENTIFIER',
+        12: 'UTF8String', 16: 'SEQUENCE', 17: 'SET', 19: 'PrintableString', 22: 'IA5String', 23: 'UTCTime',
+    }
+    def do_layout(buf, max_depth=None):
+        try:
+            for depth, offset, cls, tag, hlen, length in iter_der(buf, max_depth=max_depth, strict=False):
+                if cls == 0:
+                    name = DER_TAG_NAMES.get(tag, str(tag))
+                elif cls == 3 and tag.bit_length() > 24:
+                    name = '[PRIVATE {}]'.format(tag.to_bytes(4, byteorder='big').decode('ascii', 'replace'))
+                else:
+                    name = '[{} {}]'.format(DER_CLASSES[cls].upper(), tag)
+                line = '{:10} {:2} {}{} ({}+{})'.format(offset, depth, '  ' * depth, name, hlen, length)
+                if offset + hlen + length > len(buf):
+                    line += ' truncated'
+                elif cls == 0 and tag == IA5String.tag and length <= 64:
+                    # don't let one malformed string abort the listing
+                    line += ' ' + repr(bytes(buf[offset + hlen:offset + hlen + length]).decode('ascii', 'replace'))
+                print(line)
+        except ValueError as e:
+            print('error: {}'.format(e))
+            sys.exit(1)
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-r', '--raw', action='store_true', help='print raw parsed data')
-    parser.add_argument('infile', type=argparse.FileType('rb'), help='input .img4/.im4m/.im4p file')
-    parser.add_argument('outfile', type=argparse.FileType('wb'), nargs='?', help='output data file for payload')
-    args = parser.parse_args()
+    def do_dump(args):
+        if args.layout or args.extract:
+            if args.extract and not args.layout and not args.outfile:
+                dump_parser.error('--extract requires an output file')
+            try:
+                with _map_file(args.infile) as m:
+                    if args.layout:
+                        do_layout(m, max_depth=args.depth)
+                    else:
+                        do_extract(args, m, args.outfile)
+            except ValueError as e:
+                print('error: {}'.format(e))
+                sys.exit(1)
+            return
 
-    contents = args.infile.read()
-    errors = {}
-    for p in (IMG4, IMG4Manifest, IMG4Payload):
+        contents = args.infile.read()
         try:
-            img4 = p.load(contents)
+            img4 = load(contents)
             img4.native  # trigger parsing
-            break
         except Exception as e:
-            errors[p] = e
-    else:
-        print('Could not parse file {}:'.format(args.infile.name))
-        for (p, e) in errors.items():
-            print(' - As {}: {}'.format(p.__name__, e))
-        sys.exit(1)
-    
-    if isinstance(img4, IMG4):
-        payload = img4['payload']
-        manifest = img4['manifest']
-    elif isinstance(img4, IMG4Manifest):
-        payload = None
-        manifest = img4
-    elif isinstance(img4, IMG4Payload):
-        payload = img4
-        manifest = None
-
-    if payload:
-        p = payload.native
-        if args.raw:
-            print(restruct.format_value(p, str))
-        else:
-            print('payload:')
-            print('  type:', p['type'])
-            print('  desc:', p['description'])
-            if p['keybags']:
-                print('  keybags:')
-                keybags = payload['keybags'].parse(IMG4KeyBagSequence).native
-                for kb in keybags:
-                    print('    id: ', kb['id'])
-                    print('    iv: ', restruct.format_value(kb['iv'], str))
-                    print('    key:', restruct.format_value(kb['key'], str))
-                    print()
-            if p['compression']:
-                print('  compression:')
-                print('    algo:', p['compression']['algorithm'])
-                print('    size:', p['compression']['original_size'])
-                algo = p['compression']['algorithm']
-            else:
-                algo = None
-            print()
-
-        if args.outfile:
-            if algo == 'lzfse':
-                import lzfse
-                data = lzfse.decompress(p['data'])
-            elif algo:
-                raise ValueError('unknown algorithm: {}'.format(algo))
+            print('Could not parse file {}: {}'.format(args.infile.name, e))
+            sys.exit(1)
+
+        if isinstance(img4, IMG4):
+            payload = img4['payload']
+            manifest = img4['manifest']
+        elif isinstance(img4, IMG4Manifest):
+            payload = None
+            manifest = img4
+        elif isinstance(img4, IMG4Payload):
+            payload = img4
+            manifest = None
+
+        if payload:
+            p = payload.native
+            if args.raw:
+                print(restruct.format_value(p, str))
             else:
-                data = p['data']
-            args.outfile.write(data)
-    if manifest:
-        m = manifest.native
-        if args.raw:
-            print(restruct.format_value(m, str))
-        else:
-            print('manifest:')
-            for p in m['contents']:
-                print('  body:')
-                if p['type'] == 'MANB':
-                    for c in p['categories']:
-                        cname = c['category']['type']
-                        for v in c['category']['values']:
-                            print('    {}.{}: {}'.format(cname, v['value']['key'], restruct.format_value(v['value']['value'], str)))
+                print('payload:')
+                print('  type:', p['type'])
+                print('  desc:', p['description'])
+                if p['keybags']:
+                    print('  keybags:')
+                    keybags = payload['keybags'].parse(IMG4KeyBagSequence).native
+                    for kb in keybags:
+                        print('    id: ', kb['id'])
+                        print('    iv: ', restruct.format_value(kb['iv'], str))
+                        print('    key:', restruct.format_value(kb['key'], str))
                         print()
+                if p['compression']:
+                    print('  compression:')
+                    print('    algo:', p['compression']['algorithm'])
+                    print('    size:', p['compression']['original_size'])
+                print()
+
+            if args.outfile:
+                do_extract(args, contents, args.outfile)
+        if manifest:
+            m = manifest.native
+            if args.raw:
+                print(restruct.format_value(m, str))
+            else:
+                print('manifest:')
+                for p in m['contents']:
+                    print('  body:')
+                    if p['type'] == 'MANB':
+                        for c in p['categories']:
+                            cname = c['category']['type']
+                            for v in c['category']['values']:
+                                print('    {}.{}: {}'.format(cname, v['value']['key'], restruct.format_value(v['value']['value'], str)))
+                            print()
+    dump_parser = subparsers.add_parser('dump', help='show file contents and extract payload (default)')
+    dump_parser.add_argument('-r', '--raw', action='store_true', help='print raw parsed data')
+    dump_parser.add_argument('-l', '--layout', action='store_true', help='show DER structure with offsets and lengths, without parsing the file')
+    dump_parser.add_argument('-D', '--depth', type=int, help='maximum nesting depth to show in --layout mode')
+    dump_parser.add_argument('-x', '--extract', action='store_true', help='only extract payload to outfile, without parsing the full file')
+    dump_parser.add_argument('-k', '--key', help='decrypt payload with this hex-encoded IV and key')
+    dump_parser.add_argument('-b', '--keybag', type=int, help='decrypt payload with the IV and key from the keybag with this id')
+    dump_parser.add_argument('infile', type=argparse.FileType('rb'), help='input .img4/.im4m/.im4p file')
+    dump_parser.add_argument('outfile', type=argparse.FileType('wb'), nargs='?', help='output data file for payload')
+    dump_parser.set_defaults(func=do_dump)
+
+    def do_batch(args):
+        import json
+        for info in iter_batch(args.source, outdir=args.outdir, jobs=args.jobs):
+            sys.stdout.write(json.dumps(info, default=_json_value) + '\n')
+            sys.stdout.flush()
+    batch_parser = subparsers.add_parser('batch', help='describe many files in parallel, as JSON lines')
+    batch_parser.add_argument('-j', '--jobs', type=int, help='number of worker processes (default: CPU count)')
+    batch_parser.add_argument('-o', '--outdir', help='extract payloads into this directory, as <input name>.bin')
+    batch_parser.add_argument('source', help='directory to scan for .img4/.im4m/.im4p files, or file listing one path per line')
+    batch_parser.set_defaults(func=do_batch)
+
+    def do_build(args):
+        manifest = args.manifest.read() if args.manifest else None
+        try:
+            m = _map_file(args.infile)
+        except ValueError as e:
+            build_parser.error(str(e))
+        with m:
+            try:
+                is_payload = detect(m) is IMG4Payload
+            except ValueError:
+                is_payload = False
+        if is_payload:
+            if manifest is None:
+                build_parser.error('input is already an IM4P: a manifest is needed to build an IMG4')
+            build_img4(args.outfile, args.infile, manifest)
+            return
+
+        if not args.type:
+            build_parser.error('--type is required to build an IM4P')
+        compression = None
+        if args.compression:
+            if args.original_size is None:
+                build_parser.error('--compression requires --original-size')
+            compression = {'algorithm': args.compression, 'original_size': args.original_size}
+        keybags = []
+        for i, ivkey in enumerate(args.keybag or [], start=1):
+            ivkey = bytes.fromhex(ivkey)
+            keybags.append({'id': i, 'iv': ivkey[:AES_BLOCK_SIZE], 'key': ivkey[AES_BLOCK_SIZE:]})
+        build_payload(args.outfile, args.type, args.description, args.infile,
+            compression=compression, keybags=keybags, manifest=manifest)
+    build_parser = subparsers.add_parser('build', help='wrap raw data as an IM4P, or an IM4P and manifest as an IMG4')
+    build_parser.add_argument('-t', '--type', help='payload type (example: krnl)')
+    build_parser.add_argument('-d', '--description', default='', help='payload description')
+    build_parser.add_argument('-c', '--compression', choices=sorted(IMG4CompressionAlgorithm._map.values()), help='compression algorithm of the data')
+    build_parser.add_argument('-s', '--original-size', type=int, help='decompressed size of the data')
+    build_parser.add_argument('-k', '--keybag', action='append', help='add keybag with this hex-encoded IV and key')
+    build_parser.add_argument('-m', '--manifest', type=argparse.FileType('rb'), help='IM4M manifest to build an IMG4 with')
+    build_parser.add_argument('infile', type=argparse.FileType('rb'), help='input raw data or .im4p file')
+    build_parser.add_argument('outfile', type=argparse.FileType('wb'), help='output .im4p/.img4 file')
+    build_parser.set_defaults(func=do_build)
+
+    def do_verify(args):
+        try:
+            with _map_file(args.manifest) as m:
+                manifest = IMG4ManifestView(bytes(m))
+        except ValueError as e:
+            verify_parser.error(str(e))
+        components = {c for c in manifest.categories() if 'DGST' in manifest.index[c]}
+        failed = False
+        for result in verify_payloads(manifest, args.paths, jobs=args.jobs):
+            if result['status'] == 'error':
+                print('{}: error: {}'.format(result['path'], result['error']))
+                failed = True
+            elif result['status'] == 'unknown':
+                print('{}: {} not in manifest'.format(result['path'], result['type']))
+            else:
+                print('{}: {} {}'.format(result['path'], result['type'], 'OK' if result['status'] == 'match' else 'MISMATCH'))
+                components.discard(result['type'])
+                failed |= result['status'] != 'match'
+        if components:
+            print('no payloads found for: {}'.format(', '.join(sorted(components))))
+        if failed:
+            sys.exit(1)
+    verify_parser = subparsers.add_parser('verify', help='verify payload digests against a manifest')
+    verify_parser.add_argument('-j', '--jobs', type=int, help='number of hashing threads (default: CPU count)')
+    verify_parser.add_argument('manifest', type=argparse.FileType('rb'), help='input .im4m/.img4 file with manifest')
+    verify_parser.add_argument('paths', nargs='+', help='.im4p/.img4 files or directories to verify')
+    verify_parser.set_defaults(func=do_verify)
+
+    def do_verify_signature(args):
+        verifier = ManifestSignatureVerifier(roots=[r.read() for r in args.root or []], cache_size=args.cache_size)
+        failed = False
+        for path in args.paths:
+            paths = [p for p, _ in iter_batch_paths(path) if not p.lower().endswith('.im4p')] if os.path.isdir(path) else [path]
+            for p in paths:
+                try:
+                    with open(p, 'rb') as f:
+                        anchored = verifier.verify(IMG4ManifestView(f.read()))
+                    print('{}: OK{}'.format(p, '' if anchored else ' (chain not anchored to a root)'))
+                    failed |= bool(args.root) and not anchored
+                except Exception as e:
+                    print('{}: FAILED: {}'.format(p, e))
+                    failed = True
+        print('certificate signature cache: {} hits, {} misses'.format(verifier.hits, verifier.misses), file=sys.stderr)
+        if failed:
+            sys.exit(1)
+    verify_signature_parser = subparsers.add_parser('verify-signature', help='verify manifest signatures and certificate chains')
+    verify_signature_parser.add_argument('-r', '--root', type=argparse.FileType('rb'), action='append', help='trusted root certificate (DER or PEM)')
+    verify_signature_parser.add_argument('--cache-size', type=int, default=256, help='number of verified certificate signatures to remember')
+    verify_signature_parser.add_argument('paths', nargs='+', help='.im4m/.img4 files or directories to verify')
+    verify_signature_parser.set_defaults(func=do_verify_signature)
+
+    def do_index(args):
+        db = open_index(args.database)
+        indexed, unchanged, failed, pruned = update_index(db, args.paths, prune=args.prune)
+        print('{} indexed, {} unchanged, {} failed, {} pruned'.format(indexed, unchanged, failed, pruned))
+    index_parser = subparsers.add_parser('index', help='add manifest properties to a SQLite index')
+    index_parser.add_argument('-p', '--prune', action='store_true', help='remove indexed files that no longer exist')
+    index_parser.add_argument('database', help='index database file')
+    index_parser.add_argument('paths', nargs='+', help='.im4m/.img4 files or directories to index')
+    index_parser.set_defaults(func=do_index)
+
+    def do_query(args):
+        for path in query_index(open_index(args.database), args.conditions):
+            print(path)
+    query_parser = subparsers.add_parser('query', help='find indexed manifests by property')
+    query_parser.add_argument('database', help='index database file')
+    query_parser.add_argument('conditions', nargs='*', help='properties to match, as [CATEGORY.]KEY[=VALUE] (example: MANP.ECID=0x1234 krnl.DGST=ab12...)')
+    query_parser.set_defaults(func=do_query)
+
+    argv = sys.argv[1:]
+    if argv and argv[0] not in subparsers.choices and argv[0] not in ('-h', '--help'):
+        # plain `img4.py [-r] infile [outfile]` invocation
+        argv.insert(0, 'dump')
+    args = parser.parse_args(argv)
+    if not args.func:
+        parser.error('a subcommand must be provided')
+    args.func(args)
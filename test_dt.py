@@ -0,0 +1,95 @@
+import io
+import os
+
+import pytest
+
+restruct = pytest.importorskip('restruct')
+
+import dt
+
+
+# the generic restruct definitions can only be exercised with the real library
+needs_restruct = pytest.mark.skipif(
+    not os.path.exists(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ext', 'restruct', 'restruct.py')),
+    reason='ext/restruct is not checked out',
+)
+
+
+PROPERTY_NAMES = {'address_cells': '#address-cells', 'size_cells': '#size-cells', 'AAPL_phandle': 'AAPL,phandle'}
+
+def node(name, *children, **props):
+    properties = [dt.ADTProperty(name='name', template=False, value=name)]
+    properties += [dt.ADTProperty(name=PROPERTY_NAMES.get(k, k), template=False, value=v) for k, v in props.items()]
+    return dt.ADTNode(property_count=len(properties), properties=properties, child_count=len(children), children=list(children))
+
+
+def test_lookups_see_tree_changes():
+    root = node('device-tree', node('cpus'))
+    assert dt.get(root, ['arm-io']) == []
+
+    child = node('arm-io', compatible=['arm-io,t8103'])
+    root.children.append(child)
+    root.child_count += 1
+    assert dt.get(root, ['arm-io']) == [child]
+    assert dt.find(root, 'compatible', 'arm-io,t8103') == [['device-tree', 'arm-io']]
+
+    index = dt.DeviceTreeIndex(root)
+    assert dt.get(root, ['arm-io'], index=index) == [child]
+    assert dt.find(root, 'compatible', 'arm-io,t8103', index=index) == [['device-tree', 'arm-io']]
+
+
+def sample_tree():
+    return node('device-tree',
+        node('cpus', node('cpu0', reg=0, compatible=['apple,icestorm', 'ARM,v8']), address_cells=1, size_cells=0),
+        node('arm-io',
+            node('uart0', reg=bytes.fromhex('0000123502000000' '0040000000000000'), interrupts=bytes.fromhex('0502000006020000'), AAPL_phandle=12),
+            node('empty-node'),
+            compatible=['arm-io,t8103'], address_cells=2, size_cells=2, ranges=bytes(range(24)), AAPL_phandle=11,
+        ),
+        compatible=['J274AP', 'AppleARM'], model='J274AP', address_cells=2, size_cells=2,
+    )
+
+def values(node):
+    return [(p.name, bool(p.template), p.value) for p in node.properties], [values(c) for c in node.children]
+
+
+@needs_restruct
+def test_lazy_adt_properties_match_restruct():
+    blob = bytes(dt.to_adt(sample_tree()))
+    eager = restruct.parse(dt.AppleDeviceTree, io.BytesIO(blob))
+    lazy = dt.load_adt(blob)
+    assert isinstance(lazy.properties[0], dt.ADTProperty)
+    assert values(lazy) == values(eager)
+
+def test_load_adt_round_trip():
+    tree = sample_tree()
+    assert values(dt.load_adt(bytes(dt.to_adt(tree)))) == values(tree)
+
+
+@needs_restruct
+def test_parse_fdt_matches_restruct():
+    blob = bytes(dt.to_fdt(sample_tree()))
+    fdt = restruct.parse(dt.FlattenedDeviceTree, io.BytesIO(blob))
+    _, eager = dt.from_fdt(fdt.structs)
+    assert dt.dump(dt.parse_fdt(blob)) == dt.dump(eager)
+
+
+def test_to_fdt_round_trip():
+    tree = sample_tree()
+    assert dt.dump(dt.parse_fdt(bytes(dt.to_fdt(tree)))) == dt.dump(tree)
+
+
+@needs_restruct
+def test_to_fdt_round_trip_restruct():
+    tree = sample_tree()
+    fdt = restruct.parse(dt.FlattenedDeviceTree, io.BytesIO(bytes(dt.to_fdt(tree))))
+    assert dt.dump(dt.from_fdt(fdt.structs)[1]) == dt.dump(tree)
+
+
+def test_load_cached_tree_survives_unwritable_cache(tmp_path, capsys):
+    tree = sample_tree()
+    blob = bytes(dt.to_adt(tree))
+    cache_dir = tmp_path / 'cache'
+    cache_dir.write_bytes(b'')  # a file, so the cache directory can't be created
+    assert dt.dump(dt.load_cached_tree(blob, str(cache_dir))) == dt.dump(tree)
+    assert 'could not write tree cache' in capsys.readouterr().err
@@ -0,0 +1,135 @@
+import io
+import mmap
+import os
+import subprocess
+import sys
+
+import pytest
+
+import img4
+
+
+def der(cls, tag, *contents, constructed=True):
+    content = b''.join(contents)
+    return img4._der_encode_header(cls, constructed, tag, len(content)) + content
+
+def ia5(s):
+    return der(0, 22, s.encode('ascii'), constructed=False)
+
+
+def test_import_is_lazy():
+    """ importing img4 must not pull in the certificate, crypto or decompression modules """
+    code = 'import sys, img4; print(" ".join(m for m in ("asn1crypto.x509", "cryptography", "lzfse") if m in sys.modules))'
+    out = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(img4.__file__)),
+        check=True, capture_output=True, text=True).stdout
+    assert out.split() == []
+
+
+def test_extract_error_survives_closing_mmap(tmp_path):
+    """ a failed extraction must not leave views of the mapped input behind to mask its error """
+    lzfse = pytest.importorskip('lzfse')
+    pytest.importorskip('cryptography')
+
+    data = bytes(range(256)) * 4096
+    path = tmp_path / 'payload.im4p'
+    with open(path, 'wb') as f:
+        img4.build_payload(f, 'krnl', '', lzfse.compress(data), compression={'algorithm': 'lzfse', 'original_size': len(data)})
+
+    # the payload is not encrypted, so decrypting it produces garbage that fails to decompress
+    with open(path, 'rb') as f, pytest.raises(ValueError, match='LZFSE'):
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            img4.extract_payload(m, io.BytesIO(), iv=bytes(16), key=bytes(32))
+
+
+def test_malformed_manifest_error_survives_closing_mmap(tmp_path):
+    """ a manifest that fails to index must release its view of the mapped input """
+    # a MANP category without its property set
+    category = der(3, img4.ascii2int('MANP'), der(0, 16, ia5('MANP')))
+    body = der(3, img4.ascii2int('MANB'), der(0, 16, ia5('MANB'), der(0, 17, category)))
+    manifest = der(0, 16, ia5('IM4M'), der(0, 2, b'\x00', constructed=False), der(0, 17, body), der(0, 4, b'', constructed=False), der(0, 16))
+    path = tmp_path / 'manifest.im4m'
+    path.write_bytes(manifest)
+
+    with open(path, 'rb') as f, pytest.raises(ValueError):
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            img4.describe(m)
+
+
+def test_extract_lzss(tmp_path):
+    import zlib
+
+    data = bytes(range(256)) * 64
+    # literals only: a flag byte of all ones before every eight bytes
+    compressed = b''.join(b'\xff' + data[i:i + 8] for i in range(0, len(data), 8))
+    header = img4.LZSS_HEADER.pack(img4.LZSS_MAGIC, zlib.adler32(data), len(data), len(compressed))
+    payload = header.ljust(img4.LZSS_HEADER_SIZE, b'\x00') + compressed
+    path = tmp_path / 'kernelcache.im4p'
+    with open(path, 'wb') as f:
+        img4.build_payload(f, 'krnl', '', payload)
+
+    out = io.BytesIO()
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        assert img4.extract_payload(m, out) == ('lzss', len(payload), len(data))
+    assert out.getvalue() == data
+    assert img4.decompress(payload) == data
+
+
+@pytest.mark.parametrize('truncate', [False, True])
+def test_copy_source_short_copy(tmp_path, monkeypatch, truncate):
+    """ in-kernel copies that stop early must be completed or reported, not yield a truncated payload """
+    data = bytes(range(256)) * 64
+    src = tmp_path / 'data.bin'
+    src.write_bytes(data)
+    monkeypatch.setattr(img4.os, 'copy_file_range', lambda *args: 0, raising=False)
+    monkeypatch.delattr(img4.os, 'sendfile', raising=False)
+
+    with open(src, 'rb') as source, open(tmp_path / 'out.bin', 'wb') as outfile:
+        if truncate:
+            with open(src, 'r+b') as f:
+                f.truncate(len(data) // 2)
+            with pytest.raises(ValueError, match='shrunk'):
+                img4._copy_source(outfile, source, len(data))
+        else:
+            img4._copy_source(outfile, source, len(data))
+    if not truncate:
+        assert (tmp_path / 'out.bin').read_bytes() == data
+
+
+def _certificate(name, key, issuer_name, issuer_key, ca):
+    import datetime
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+
+    start = datetime.datetime(2020, 1, 1)
+    cert = (x509.CertificateBuilder()
+        .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, name)]))
+        .issuer_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, issuer_name)]))
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(start)
+        .not_valid_after(start + datetime.timedelta(days=3650))
+        .add_extension(x509.BasicConstraints(ca=ca, path_length=None), critical=True)
+        .sign(issuer_key, hashes.SHA256()))
+    return cert.public_bytes(serialization.Encoding.DER)
+
+def test_verify_chain_requires_ca_issuers():
+    pytest.importorskip('cryptography')
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    keys = {name: ec.generate_private_key(ec.SECP256R1()) for name in ('root', 'intermediate', 'leaf', 'other', 'evil')}
+    root = _certificate('Root', keys['root'], 'Root', keys['root'], ca=True)
+    intermediate = _certificate('Intermediate', keys['intermediate'], 'Root', keys['root'], ca=True)
+    leaf = _certificate('Leaf', keys['leaf'], 'Intermediate', keys['intermediate'], ca=False)
+    other = _certificate('Other', keys['other'], 'Intermediate', keys['intermediate'], ca=False)
+    evil = _certificate('Evil', keys['evil'], 'Leaf', keys['leaf'], ca=False)
+
+    verifier = img4.ManifestSignatureVerifier(roots=[root])
+    assert verifier.verify_chain([leaf, intermediate])[1]
+    assert verifier.misses == 2 and verifier.hits == 0
+    # the intermediate's link to the root is shared, so only the new leaf is checked
+    assert verifier.verify_chain([other, intermediate])[1]
+    assert verifier.misses == 3 and verifier.hits == 1
+
+    with pytest.raises(ValueError, match='not a CA'):
+        verifier.verify_chain([evil, leaf, intermediate])